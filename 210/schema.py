@@ -30,4 +30,7 @@ SYSTEM_PROMPT = """
  is_ad : 是否是广告/推广（检查是否有 "Pub", "Ad", "Sponsored", "Promoted", "推广" 等标签）。
 """
 
-USER_PROMPT_TEXT = "请提取这张图中的所有商品信息"
\ No newline at end of file
+USER_PROMPT_TEXT = "请提取这张图中的所有商品信息"
+
+# 5. 长截图分块提取 (见 extract.py 的 TILING)
+TILING = True
@@ -24,4 +24,7 @@ SYSTEM_PROMPT = """
  review_count : 评论数量。
 """
 
-USER_PROMPT_TEXT = "请提取这张图中的所有旅馆信息"
\ No newline at end of file
+USER_PROMPT_TEXT = "请提取这张图中的所有旅馆信息"
+
+# 5. 参与者常重复提交同一页面的截图，按感知哈希复用结果 (见 extract.py 的 NEAR_DUPLICATES)
+NEAR_DUPLICATES = True
@@ -23,4 +23,7 @@ SYSTEM_PROMPT = """
  price : 价格数值。如果有原价和折后价，提取红色的/加粗的/较低的折后价格。只提取数字。如果不是欧元转换成欧元
 """
 
-USER_PROMPT_TEXT = "请提取这张图中的当前选中的商品信息"
\ No newline at end of file
+USER_PROMPT_TEXT = "请提取这张图中的当前选中的商品信息"
+
+# 5. 输出很短，多张截图打包进一个请求 (见 extract.py 的 IMAGES_PER_REQUEST)
+IMAGES_PER_REQUEST = 5
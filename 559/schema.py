@@ -28,4 +28,8 @@ SYSTEM_PROMPT = """
  rating : 评分（例如 8.5, 9.0）。
 """
 
-USER_PROMPT_TEXT = "请提取这张图中的所有旅馆信息"
\ No newline at end of file
+USER_PROMPT_TEXT = "请提取这张图中的所有旅馆信息"
+
+# 5. 长截图分块提取 (见 extract.py 的 TILING)，排名字段为 position
+TILING = True
+RANK_FIELD = "position"
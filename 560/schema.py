@@ -28,4 +28,7 @@ SYSTEM_PROMPT = """
  rating : 评分（例如 8.5, 9.0）。
 """
 
-USER_PROMPT_TEXT = "请提取这张图中的所有旅馆信息"
\ No newline at end of file
+USER_PROMPT_TEXT = "请提取这张图中的所有旅馆信息"
+
+# 5. 排名字段为 position (默认为 rank)，补提取字段时按它匹配已有的行
+RANK_FIELD = "position"
@@ -7,6 +7,7 @@ class ItemModel(BaseModel):
     rank: int
     product_name: Optional[str]
     price: Optional[float]
+    is_search_result: bool
     rating: Optional[float]
     review_count:Optional[int]
 
@@ -24,8 +25,16 @@ SYSTEM_PROMPT = """
  product_name : 商品名称。如果截断看不清，返回 null。
  price : 价格数值。如果有原价和折后价，提取红色的/加粗的/较低的折后价格。只提取数字。如果不是欧元转换成欧元
  rank : 该商品在当前截图中的视觉顺序（从上到下，从1开始）。
+ is_search_result : 该商品是否属于搜索结果列表本身。列表中的商品 (包括列表里的推广商品) 返回 true；页面其它区域的商品 (如推荐、“猜你喜欢”、最近浏览、横幅) 返回 false。
  rating : 评分（例如 8.5, 9.0）。
  review_count : 商品评价数量
 """
 
-USER_PROMPT_TEXT = "请提取这张图中的所有商品信息"
\ No newline at end of file
+USER_PROMPT_TEXT = "请提取这张图中的所有商品信息"
+
+# 5. 写入前的过滤钩子 (见 extract.py 的 DirectoryJob.apply_hooks)：只保留搜索结果
+ITEM_FILTERS = [lambda item: item.is_search_result]
+# 过滤钩子读取的字段，补提取其它字段时也一并提取，按同样的规则过滤后排名才能对上
+ITEM_FILTER_FIELDS = ["is_search_result"]
+# 旧结果中混有非搜索结果的条目，schema 更新后重新提取这些图片
+SCHEMA_MIGRATION = "reextract"
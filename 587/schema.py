@@ -32,4 +32,7 @@ SYSTEM_PROMPT = """
  discount : 折扣（如果有的话，提取折扣百分比，如果是-15%就是0.15）。
 """
 
-USER_PROMPT_TEXT = "请提取这张图中的所有商品信息"
\ No newline at end of file
+USER_PROMPT_TEXT = "请提取这张图中的所有商品信息"
+
+# 5. 长截图分块提取 (见 extract.py 的 TILING)
+TILING = True
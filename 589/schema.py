@@ -25,4 +25,7 @@ SYSTEM_PROMPT = """
  stock_count : 商品库存（例如Only 6 left in stock）
 """
 
-USER_PROMPT_TEXT = "请提取这张图中的当前选中的商品信息"
\ No newline at end of file
+USER_PROMPT_TEXT = "请提取这张图中的当前选中的商品信息"
+
+# 5. 输出很短，多张截图打包进一个请求 (见 extract.py 的 IMAGES_PER_REQUEST)
+IMAGES_PER_REQUEST = 5
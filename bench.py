@@ -0,0 +1,612 @@
+"""
+性能基准脚本。
+
+用本地合成数据模拟 /api/results 接口 (带人工延迟)，不访问真实服务器。
+运行: python bench.py
+
+重新登录基准用会让 token 定时过期的本地 session，检查多个 job 并发遇到 401 时
+AuthManager 是否只重新登录一次 (登录次数 = 被拒绝的 token 数 + 1)。
+
+并发提取基准用本地的假模型客户端 (固定延迟) 比较 extract.run_extraction 串行和并发的耗时，
+并检查 results.csv 中每张图片的行连续写入、没有交错。
+
+批量模式基准用本地的假 Batch API 客户端跑完 extract.run_batch 的写入、提交、轮询和收取，
+包括提交后中断、从 .batches/state.json 继续收取，不访问 OpenAI。
+
+图片预处理基准读取本地已下载的任务目录 (需要图片和 results.csv)，
+并真实调用模型 (需要 OPENAI_API_KEY)，比较延迟和与现有 results.csv 的一致率。
+"""
+import os
+import csv
+import json
+import time
+import base64
+import shutil
+import tempfile
+import threading
+from types import SimpleNamespace
+from collections import defaultdict
+
+import requests
+
+import spider
+
+# ================= 配置 =================
+BENCH_PAGE_COUNT = 20 # 合成 job 的页数
+BENCH_PAGE_SIZE = 20 # 每页记录数
+BENCH_IMAGE_BYTES = 300_000 # 每张合成截图的大小 (接近真实手机截图)
+BENCH_LATENCY = 0.5 # 每个请求的人工延迟 (秒)
+BENCH_REAUTH_JOBS = 8 # 重新登录基准中并发的 job 数
+BENCH_TOKEN_LIFETIME = 40 # 重新登录基准中每个 token 可用于的数据请求数，用完即过期
+BENCH_REAUTH_LATENCY = 0.02 # 重新登录基准中每个请求的人工延迟 (秒)
+BENCH_EXTRACT_DIR = os.path.dirname(os.path.abspath(__file__)) # 任务目录所在位置
+BENCH_EXTRACT_SAMPLE = 10 # 每个任务目录抽样的图片数
+BENCH_CHAT_LATENCY = 0.2 # 并发提取基准中每次模型调用的人工延迟 (秒)
+BENCH_CHAT_DIRS = 2 # 并发提取基准的合成任务目录数
+BENCH_CHAT_IMAGES = 16 # 并发提取基准中每个目录的合成图片数
+BENCH_BATCH_IMAGES = 12 # 批量模式基准的合成图片数
+BENCH_BATCH_FAIL_EVERY = 5 # 假批次中每隔多少个请求返回一次错误 (0 表示全部成功)
+# =======================================
+
+
+class FakeResponse:
+    def __init__(self, data, status_code=200):
+        self.data = data
+        self.status_code = status_code
+        self.headers = {}
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"HTTP {self.status_code}", response=self)
+
+    def json(self):
+        return self.data
+
+
+class FakeResultsSession:
+    """模拟 /api/results 的 session：按 page_id 返回合成记录，每次请求固定延迟。"""
+
+    def __init__(self, page_count=BENCH_PAGE_COUNT, page_size=BENCH_PAGE_SIZE,
+                 image_bytes=BENCH_IMAGE_BYTES, latency=BENCH_LATENCY):
+        self.page_count = page_count
+        self.page_size = page_size
+        self.latency = latency
+        self.screenshot = base64.b64encode(os.urandom(image_bytes)).decode('ascii')
+        self.lock = threading.Lock()
+        self.request_count = 0
+
+    def get(self, url, headers=None, params=None, **kwargs):
+        time.sleep(self.latency)
+        with self.lock:
+            self.request_count += 1
+        page_id = int(params['page_id'])
+        total = self.page_count * self.page_size
+        content = []
+        for i in range(page_id * self.page_size, (page_id + 1) * self.page_size):
+            _id = total - i
+            content.append({
+                'id': _id,
+                'job_id': int(params['job_id']),
+                'timestamp': 1700000000000 + _id,
+                'participant': {'id': f'participant-{_id % 7}'},
+                'screenshot': self.screenshot,
+            })
+        return FakeResponse({'id': 0, 'size': self.page_size, 'page_count': self.page_count,
+                             'entity_count': len(content), 'content': content})
+
+
+class FakeAuthSession(FakeResultsSession):
+    """在 FakeResultsSession 上模拟 /api/sessions 登录和 token 过期。
+
+    PUT 登录签发新 token，每个 token 被接受 token_lifetime 次数据请求后过期；
+    带过期 token (或未知 token) 的数据请求返回 401。按请求数而不是时间过期，
+    过期次数与线程调度无关，结果可复现。接口与 requests.Session.request 相同，
+    可以放在 spider.Transport 下面。记录登录次数和被 401 拒绝过的 token。
+    """
+
+    def __init__(self, token_lifetime=BENCH_TOKEN_LIFETIME, **kwargs):
+        super().__init__(**kwargs)
+        self.token_lifetime = token_lifetime
+        self.issued = {} # token -> 剩余可用的请求数
+        self.rejected = set()
+        self.login_count = 0
+
+    def request(self, method, url, headers=None, **kwargs):
+        if method == 'PUT':
+            return self.put(url, headers=headers, **kwargs)
+        return self.get(url, headers=headers, **kwargs)
+
+    def put(self, url, **kwargs):
+        with self.lock:
+            self.login_count += 1
+            token = f"bench-token-{self.login_count:04d}-xxxxxxxx"
+            self.issued[token] = self.token_lifetime
+        return FakeResponse({'token': token})
+
+    def get(self, url, headers=None, params=None, **kwargs):
+        token = (headers or {}).get('Authorization', '').removeprefix('Bearer ')
+        with self.lock:
+            if self.issued.get(token, 0) <= 0:
+                self.rejected.add(token)
+                return FakeResponse({'message': 'token expired'}, status_code=401)
+            self.issued[token] -= 1
+        return super().get(url, headers=headers, params=params, **kwargs)
+
+
+class SimulatedInterrupt(Exception):
+    """假客户端模拟脚本在轮询批次时被中断。"""
+
+
+def sample_from_schema(schema, defs=None):
+    """按 JSON schema 生成一个最小的合法实例 (数组生成两项)，作为假批次的模型输出。"""
+    defs = defs if defs is not None else schema.get('$defs', {})
+    if '$ref' in schema:
+        return sample_from_schema(defs[schema['$ref'].rsplit('/', 1)[-1]], defs)
+    if 'anyOf' in schema:
+        options = [option for option in schema['anyOf'] if option.get('type') != 'null']
+        return sample_from_schema(options[0], defs) if options else None
+    kind = schema.get('type')
+    if kind == 'object':
+        return {name: sample_from_schema(prop, defs) for name, prop in schema.get('properties', {}).items()}
+    if kind == 'array':
+        return [sample_from_schema(schema.get('items', {}), defs) for _ in range(2)]
+    return {'string': 'bench', 'integer': 1, 'number': 1.0, 'boolean': True}.get(kind)
+
+
+class FakeChatClient:
+    """模拟 extract.call_model 用到的
+    client.with_options(...).beta.chat.completions.with_raw_response.parse。
+
+    每次调用固定延迟 latency 秒，返回按 response_format 生成的合法结果，
+    并记录调用次数和同时在途的最大调用数。
+    """
+
+    def __init__(self, latency=BENCH_CHAT_LATENCY):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.in_flight = 0
+        self.peak = 0
+        self.beta = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(
+            with_raw_response=SimpleNamespace(parse=self.parse))))
+
+    def with_options(self, **kwargs):
+        return self
+
+    def parse(self, model, messages, response_format):
+        with self.lock:
+            self.calls += 1
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+        try:
+            time.sleep(self.latency)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+        parsed = response_format.model_validate(sample_from_schema(response_format.model_json_schema()))
+        response = SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(parsed=parsed))],
+                                   usage=SimpleNamespace(total_tokens=100))
+        return SimpleNamespace(headers={}, parse=lambda: response)
+
+
+class FakeBatchClient:
+    """模拟 extract 批量模式用到的 OpenAI 接口：files.create / files.content、
+    batches.create / batches.retrieve。
+
+    批次在被查询 polls_until_done 次后完成，输出按请求中的 response_format 生成；
+    fail_every 非 0 时每隔这么多个请求返回一次 500。interrupt 为 True 时查询批次
+    抛出 SimulatedInterrupt，模拟提交后脚本被中断。上传和批次保存在实例中，
+    同一个实例可以跨多次 run_batch 使用，就像服务端一直保留着批次。
+    """
+
+    def __init__(self, polls_until_done=2, fail_every=BENCH_BATCH_FAIL_EVERY):
+        self.polls_until_done = polls_until_done
+        self.fail_every = fail_every
+        self.interrupt = False
+        self.stored_files = {} # file_id -> 内容
+        self.stored_batches = {} # batch_id -> SimpleNamespace
+        self.calls = defaultdict(int)
+        self.files = SimpleNamespace(create=self.create_file, content=self.file_content)
+        self.batches = SimpleNamespace(create=self.create_batch, retrieve=self.retrieve_batch)
+
+    def create_file(self, file, purpose):
+        self.calls['files.create'] += 1
+        file_id = f"file-{len(self.stored_files) + 1}"
+        self.stored_files[file_id] = file.read()
+        return SimpleNamespace(id=file_id, purpose=purpose)
+
+    def file_content(self, file_id):
+        self.calls['files.content'] += 1
+        return SimpleNamespace(text=self.stored_files[file_id].decode('utf-8'))
+
+    def create_batch(self, input_file_id, endpoint, completion_window):
+        self.calls['batches.create'] += 1
+        total = len(self.stored_files[input_file_id].splitlines())
+        batch = SimpleNamespace(id=f"batch-{len(self.stored_batches) + 1}", status="validating",
+                                input_file_id=input_file_id, output_file_id=None, polls=0,
+                                request_counts=SimpleNamespace(completed=0, total=total))
+        self.stored_batches[batch.id] = batch
+        return batch
+
+    def retrieve_batch(self, batch_id):
+        self.calls['batches.retrieve'] += 1
+        if self.interrupt:
+            raise SimulatedInterrupt(f"查询 {batch_id} 时中断")
+        batch = self.stored_batches[batch_id]
+        if batch.status == "completed":
+            return batch
+        batch.polls += 1
+        if batch.polls < self.polls_until_done:
+            batch.status = "in_progress"
+            return batch
+        lines = []
+        for i, line in enumerate(self.stored_files[batch.input_file_id].splitlines(), start=1):
+            request = json.loads(line)
+            if self.fail_every and i % self.fail_every == 0:
+                response = {'status_code': 500, 'body': {'error': {'message': 'bench failure'}}}
+            else:
+                schema = request['body']['response_format']['json_schema']['schema']
+                content = json.dumps(sample_from_schema(schema), ensure_ascii=False)
+                response = {'status_code': 200, 'body': {'choices': [{'message': {'content': content}}]}}
+            lines.append(json.dumps({'custom_id': request['custom_id'], 'response': response, 'error': None}))
+        batch.output_file_id = f"file-{len(self.stored_files) + 1}"
+        self.stored_files[batch.output_file_id] = "\n".join(lines).encode('utf-8')
+        batch.status = "completed"
+        batch.request_counts.completed = batch.request_counts.total
+        return batch
+
+
+def two_pass_job(session, token, job_id):
+    """旧流程：先取回整个 job，json.dump 一次性写入内嵌截图的 data.json，再单线程遍历解码截图。"""
+    data_headers = spider.HEADERS.copy()
+    data_headers['Authorization'] = f"Bearer {token}"
+    params = {'page_id': '0', 'job_id': str(job_id), 'order': 'desc', 'hidden': 'false'}
+
+    result_json = spider.fetch_page(session, data_headers, params, 0)
+    all_content = list(result_json.get('content', []))
+    for _, content in spider.fetch_pages_in_order(session, data_headers, params, job_id,
+                                                  result_json.get('page_count', 1)):
+        all_content.extend(content)
+
+    output_dir = os.path.join(spider.IMAGE_DIR_BASE, str(job_id))
+    os.makedirs(output_dir, exist_ok=True)
+    final_json = result_json.copy()
+    final_json['content'] = all_content
+    final_json['entity_count'] = len(all_content)
+    with open(os.path.join(output_dir, spider.LEGACY_OUTPUT_FILE_NAME), 'w', encoding='utf-8') as f:
+        json.dump(final_json, f, ensure_ascii=False, indent=4)
+    spider.save_screenshots(final_json, output_dir)
+
+
+def bench_screenshot_pipeline():
+    """对比两遍式流程和流水线式 process_job 的墙钟时间。"""
+    print(f"\n{'='*50}")
+    print("截图流水线基准")
+    print(f"合成 job: {BENCH_PAGE_COUNT} 页 x {BENCH_PAGE_SIZE} 条, "
+          f"每张截图 {BENCH_IMAGE_BYTES // 1000} KB, 请求延迟 {BENCH_LATENCY}s")
+    print(f"{'='*50}")
+
+    results = {}
+    for name, run in (('two-pass', two_pass_job), ('pipeline', spider.process_job)):
+        work_dir = tempfile.mkdtemp(prefix='bench_spider_')
+        old_base = spider.IMAGE_DIR_BASE
+        spider.IMAGE_DIR_BASE = work_dir
+        try:
+            session = FakeResultsSession()
+            started_at = time.perf_counter()
+            run(session, 'bench-token', '1')
+            results[name] = time.perf_counter() - started_at
+        finally:
+            spider.IMAGE_DIR_BASE = old_base
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(f"\n   two-pass: {results['two-pass']:.2f}s")
+    print(f"   pipeline: {results['pipeline']:.2f}s")
+    print(f"   加速比: {results['two-pass'] / results['pipeline']:.2f}x")
+    return results
+
+
+def bench_reauth(job_count=BENCH_REAUTH_JOBS):
+    """多个 job 共用一个 Transport 和 AuthManager 爬取，token 在中途多次过期。
+
+    并发线程同时收到 401 时应只有一个线程重新登录，所以登录次数应等于
+    被拒绝过的 token 数 + 1 (首次登录)。多出来的登录说明去重失效。
+    """
+    print(f"\n{'='*50}")
+    print("重新登录去重基准")
+    print(f"{job_count} 个 job 并发, 每个 token 可用 {BENCH_TOKEN_LIFETIME} 次请求, 请求延迟 {BENCH_REAUTH_LATENCY}s")
+    print(f"{'='*50}")
+
+    work_dir = tempfile.mkdtemp(prefix='bench_reauth_')
+    old_base = spider.IMAGE_DIR_BASE
+    spider.IMAGE_DIR_BASE = work_dir
+    try:
+        session = FakeAuthSession(latency=BENCH_REAUTH_LATENCY, image_bytes=1000)
+        transport = spider.Transport(session, bucket=spider.TokenBucket(rate=spider.RATE_LIMIT_MAX))
+        auth = spider.AuthManager(transport)
+        if not auth.login():
+            return None
+        transport.auth = auth
+        job_ids = [str(job_id) for job_id in range(1, job_count + 1)]
+        reports = spider.run_jobs(transport, auth.token, job_ids)
+    finally:
+        spider.IMAGE_DIR_BASE = old_base
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    errors = sum(len(report['errors']) for report in reports)
+    expected = len(session.rejected) + 1
+    print(f"\n   登录次数: {session.login_count}，被拒绝的 token: {len(session.rejected)}，"
+          f"401 重放: {transport.stats['reauth']}，错误: {errors}")
+    if session.login_count == expected:
+        print("   去重正常：每个过期的 token 只重新登录一次。")
+    else:
+        print(f"   去重失效：期望 {expected} 次登录，实际 {session.login_count} 次。")
+    return session.login_count, expected
+
+
+BENCH_SCHEMA = """from typing import List, Optional
+from pydantic import BaseModel
+
+class ItemModel(BaseModel):
+    rank: int
+    product_name: Optional[str]
+    price: Optional[float]
+
+class ResponseModel(BaseModel):
+    items: List[ItemModel]
+
+LIST_FIELD_NAME = "items"
+SYSTEM_PROMPT = "bench"
+USER_PROMPT_TEXT = "bench"
+"""
+
+def import_extract():
+    """导入 extract。extract 在导入时创建 OpenAI 客户端，没有 API key 时先用占位 key 创建，
+    只供之后把 extract.client 替换为本地假客户端的基准使用。"""
+    if os.environ.get("OPENAI_API_KEY"):
+        import extract
+        return extract
+    os.environ["OPENAI_API_KEY"] = "bench-placeholder"
+    try:
+        import extract
+    finally:
+        del os.environ["OPENAI_API_KEY"]
+    return extract
+
+def make_bench_directory(work_dir, name, image_count):
+    """在 work_dir 下创建一个合成任务目录：BENCH_SCHEMA 和 image_count 张随机字节的“截图”。"""
+    directory = os.path.join(work_dir, name)
+    os.makedirs(directory)
+    with open(os.path.join(directory, 'schema.py'), 'w', encoding='utf-8') as f:
+        f.write(BENCH_SCHEMA)
+    for i in range(image_count):
+        with open(os.path.join(directory, f"17000000000{i:02d}_{i}.jpg"), 'wb') as f:
+            f.write(os.urandom(2000))
+    return directory
+
+def count_csv_rows(csv_path):
+    if not os.path.exists(csv_path):
+        return 0
+    with open(csv_path, mode='r', encoding='utf-8-sig') as f:
+        return sum(1 for _ in csv.DictReader(f))
+
+def interleaved_files(csv_path):
+    """返回 results.csv 中行不连续 (被其它图片的行隔开) 的文件名列表。"""
+    seen = set()
+    interleaved = []
+    previous = None
+    with open(csv_path, mode='r', encoding='utf-8-sig') as f:
+        for row in csv.DictReader(f):
+            filename = row['filename']
+            if filename != previous:
+                if filename in seen:
+                    interleaved.append(filename)
+                seen.add(filename)
+                previous = filename
+    return interleaved
+
+def bench_concurrent_extraction(dir_count=BENCH_CHAT_DIRS, image_count=BENCH_CHAT_IMAGES):
+    """用 FakeChatClient 分别以 1 个和 MAX_WORKERS 个线程跑 extract.run_extraction，
+    比较耗时，并检查每个目录的 results.csv 中同一图片的行没有交错。"""
+    print(f"\n{'='*50}")
+    print("并发提取 (假模型客户端) 基准")
+    print(f"{dir_count} 个目录 x {image_count} 张合成图片, 每次调用延迟 {BENCH_CHAT_LATENCY}s")
+    print(f"{'='*50}")
+    extract = import_extract()
+
+    saved = (extract.client, extract.USE_CACHE, extract.PREPROCESS_IMAGES, extract.limiter)
+    extract.USE_CACHE = False # 基准需要真实调用 (假) 模型
+    extract.PREPROCESS_IMAGES = False # 合成图片不是真正的 JPEG
+    results = {}
+    try:
+        for name, max_workers in (('sequential', 1), ('concurrent', extract.MAX_WORKERS)):
+            work_dir = tempfile.mkdtemp(prefix='bench_extract_')
+            try:
+                directories = [make_bench_directory(work_dir, f"job{i}", image_count) for i in range(dir_count)]
+                fake = FakeChatClient()
+                extract.client = fake
+                extract.limiter = extract.AdaptiveLimiter(max_limit=max_workers)
+                jobs = [extract.prepare_directory(directory) for directory in directories]
+                started_at = time.perf_counter()
+                extract.run_extraction(jobs, max_workers=max_workers)
+                elapsed = time.perf_counter() - started_at
+                csv_paths = [os.path.join(directory, 'results.csv') for directory in directories]
+                results[name] = {
+                    'elapsed': elapsed,
+                    'calls': fake.calls,
+                    'peak': fake.peak,
+                    'rows': sum(count_csv_rows(path) for path in csv_paths),
+                    'interleaved': sum(len(interleaved_files(path)) for path in csv_paths),
+                }
+            finally:
+                shutil.rmtree(work_dir, ignore_errors=True)
+    finally:
+        extract.client, extract.USE_CACHE, extract.PREPROCESS_IMAGES, extract.limiter = saved
+
+    print()
+    for name, stats in results.items():
+        print(f"   {name:>10}: {stats['elapsed']:.2f}s，调用 {stats['calls']} 次，最大并发 {stats['peak']}，"
+              f"写入 {stats['rows']} 行，行交错的图片 {stats['interleaved']} 张")
+    print(f"   加速比: {results['sequential']['elapsed'] / results['concurrent']['elapsed']:.2f}x")
+    return results
+
+def bench_batch_resume(image_count=BENCH_BATCH_IMAGES):
+    """用 FakeBatchClient 跑 extract.run_batch 三次：
+
+    1. 写请求文件、上传、创建批次后在轮询时中断，批次 id 应留在 .batches/state.json；
+    2. 重新运行，收取 state.json 中的批次而不重复上传，随后只为其中失败的图片提交新批次；
+    3. 再次运行，所有图片都已处理，不再提交。
+    """
+    print(f"\n{'='*50}")
+    print("批量模式 (假 Batch API) 基准")
+    print(f"{image_count} 张合成图片, 每 {BENCH_BATCH_FAIL_EVERY} 个请求失败一次")
+    print(f"{'='*50}")
+    extract = import_extract()
+
+    work_dir = tempfile.mkdtemp(prefix='bench_batch_')
+    directory = make_bench_directory(work_dir, 'bench', image_count)
+
+    saved = (extract.client, extract.USE_CACHE, extract.BATCH_DIR, extract.PREPROCESS_IMAGES)
+    fake = FakeBatchClient()
+    extract.client = fake
+    extract.USE_CACHE = False # 缓存命中的图片不进入批次，基准需要全部提交
+    extract.BATCH_DIR = os.path.join(work_dir, '.batches')
+    extract.PREPROCESS_IMAGES = False # 合成图片不是真正的 JPEG
+    csv_path = os.path.join(directory, 'results.csv')
+    runs = []
+    try:
+        for run in range(3):
+            fake.interrupt = run == 0
+            try:
+                extract.run_batch([extract.prepare_directory(directory)], poll_interval=0)
+            except SimulatedInterrupt as e:
+                print(f"   模拟中断: {e}")
+            runs.append({'uploads': fake.calls['files.create'], 'batches': fake.calls['batches.create'],
+                         'state': len(extract.load_batch_state()), 'rows': count_csv_rows(csv_path)})
+    finally:
+        extract.client, extract.USE_CACHE, extract.BATCH_DIR, extract.PREPROCESS_IMAGES = saved
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    failed = image_count // BENCH_BATCH_FAIL_EVERY if BENCH_BATCH_FAIL_EVERY else 0
+    submitted = 2 if failed else 1
+    expected = [
+        {'uploads': 1, 'batches': 1, 'state': 1, 'rows': 0},
+        {'uploads': submitted, 'batches': submitted, 'state': 0, 'rows': image_count * 2},
+        {'uploads': submitted, 'batches': submitted, 'state': 0, 'rows': image_count * 2},
+    ]
+    print()
+    for i, (actual, wanted) in enumerate(zip(runs, expected), start=1):
+        status = "OK" if actual == wanted else f"期望 {wanted}"
+        print(f"   第 {i} 次运行: 上传 {actual['uploads']}，批次 {actual['batches']}，"
+              f"state.json 中 {actual['state']} 个，results.csv {actual['rows']} 行 -> {status}")
+    return runs
+
+
+def load_csv_rows(csv_path):
+    """按文件名分组读取现有 results.csv，作为一致率的参照。"""
+    rows = defaultdict(list)
+    if not os.path.exists(csv_path):
+        return rows
+    with open(csv_path, mode='r', encoding='utf-8-sig') as f:
+        for row in csv.DictReader(f):
+            rows[row['filename']].append(row)
+    return rows
+
+def same_value(expected, actual):
+    """CSV 中的字符串与模型输出比较：数字按数值比较，其余忽略大小写和首尾空白。"""
+    if actual is None:
+        return expected in (None, '')
+    try:
+        return abs(float(expected) - float(actual)) < 1e-6
+    except (TypeError, ValueError):
+        return str(expected).strip().lower() == str(actual).strip().lower()
+
+def agreement(expected_rows, items_list, fields):
+    """逐条、逐字段比较，返回 (一致的字段数, 比较的字段数)。条数不同时缺失的条目算作不一致。"""
+    matched = total = 0
+    for i in range(max(len(expected_rows), len(items_list))):
+        for field in fields:
+            total += 1
+            if i < len(expected_rows) and i < len(items_list):
+                matched += same_value(expected_rows[i].get(field), getattr(items_list[i], field, None))
+    return matched, total
+
+def bench_image_preprocessing(base_dir=BENCH_EXTRACT_DIR, sample=BENCH_EXTRACT_SAMPLE):
+    """对比原图和预处理后图片的上传字节数、模型调用延迟和与现有 results.csv 的一致率。"""
+    print(f"\n{'='*50}")
+    print("图片预处理基准")
+    print(f"{'='*50}")
+    if not os.environ.get("OPENAI_API_KEY"):
+        print("未设置 OPENAI_API_KEY，跳过。")
+        return None
+    import extract # extract 在导入时创建 OpenAI 客户端，放在这里避免影响爬虫基准
+
+    if extract.Image is None:
+        print("未安装 Pillow，跳过。")
+        return None
+
+    old_preprocess, old_cache = extract.PREPROCESS_IMAGES, extract.cache
+    extract.cache = None # 基准必须真实调用模型
+    totals = {'original': defaultdict(float), 'preprocessed': defaultdict(float)}
+    try:
+        for name in sorted(os.listdir(base_dir)):
+            directory = os.path.join(base_dir, name)
+            if not os.path.isdir(directory):
+                continue
+            schema = extract.load_schema_module(directory)
+            if not schema:
+                continue
+            images = sorted(f for f in os.listdir(directory) if f.lower().endswith(('.jpg', '.jpeg', '.png')))[:sample]
+            if not images:
+                continue
+            expected = load_csv_rows(os.path.join(directory, "results.csv"))
+            fields = list(schema.ItemModel.model_fields.keys())
+
+            print(f"  [{name}] 抽样 {len(images)} 张图片")
+            for mode, preprocess in (('original', False), ('preprocessed', True)):
+                extract.PREPROCESS_IMAGES = preprocess
+                stats = totals[mode]
+                for filename in images:
+                    path = os.path.join(directory, filename)
+                    base64_img, _ = extract.read_image(path, schema)
+                    stats['bytes'] += len(base64_img) * 3 / 4
+                    stats['images'] += 1
+                    started_at = time.perf_counter()
+                    try:
+                        items_list = extract.extract_items(schema, path)
+                    except Exception as e:
+                        print(f"  -> [{name}] {mode} 调用失败: {filename}: {e}")
+                        continue
+                    stats['latency'] += time.perf_counter() - started_at
+                    stats['calls'] += 1
+                    if filename in expected:
+                        matched, total = agreement(expected[filename], items_list, fields)
+                        stats['matched'] += matched
+                        stats['compared'] += total
+    finally:
+        extract.PREPROCESS_IMAGES, extract.cache = old_preprocess, old_cache
+
+    for mode, stats in totals.items():
+        if not stats['images']:
+            continue
+        summary = f"   {mode:>12}: 平均上传 {stats['bytes'] / stats['images'] / 1000:.0f} KB"
+        if stats['calls']:
+            summary += f"，平均延迟 {stats['latency'] / stats['calls']:.2f}s"
+        if stats['compared']:
+            summary += f"，与 results.csv 一致率 {stats['matched'] / stats['compared']:.1%}"
+        print(summary)
+    if totals['original']['bytes']:
+        saved = 1 - totals['preprocessed']['bytes'] / totals['original']['bytes']
+        print(f"   节省上传字节: {saved:.0%}")
+    return totals
+
+
+def main():
+    bench_screenshot_pipeline()
+    bench_reauth()
+    bench_concurrent_extraction()
+    bench_batch_resume()
+    bench_image_preprocessing()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+"""
+把所有任务目录的提取结果合并导出为按 job_id 分区的 Parquet 数据集。
+
+有 results.sqlite (extract.py 的类型化 sqlite 后端) 的目录直接按类型读取，否则解析 results.csv。
+列类型取自各目录 schema.py 中的 ItemModel，基础元数据列 (filename、time、participant_id 等)
+在所有分区中类型一致。结果文件和 schema.py 都没有变化的目录不会重复导出。
+运行: python export.py
+读取: load_dataset(columns=[...], job_ids=[...]) 只读取需要的列和分区；
+      load_results(目录) 读取单个目录的类型化结果。
+"""
+import os
+import csv
+import sqlite3
+import types
+import typing
+import importlib.util
+from datetime import datetime
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+# ================= 配置 =================
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+DATASET_DIR = os.path.join(ROOT_DIR, "dataset") # 导出的数据集目录，其下为 job_id=<目录名>/part-0.parquet
+CSV_FILE_NAME = "results.csv"
+RESULTS_DB_NAME = "results.sqlite" # extract.py 的类型化结果数据库
+PARQUET_COMPRESSION = "zstd"
+# =======================================
+
+# 所有任务共享的基础元数据列，顺序与 extract.py 写出的 CSV 表头一致
+BASE_FIELDS = [
+    ('filename', pa.string()),
+    ('time', pa.timestamp('ms')),
+    ('participant_id', pa.string()),
+    ('device_model', pa.string()),
+    ('android_version', pa.string()),
+    ('screen_width', pa.int32()),
+    ('screen_height', pa.int32()),
+]
+
+def load_schema_module(directory):
+    """动态加载子目录下的 schema.py 模块 (与 extract.py 相同，但不创建 OpenAI 客户端)"""
+    schema_path = os.path.join(directory, "schema.py")
+    if not os.path.exists(schema_path):
+        return None
+    spec = importlib.util.spec_from_file_location("schema_module", schema_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def arrow_type(annotation):
+    """把 ItemModel 字段的类型注解映射为 Arrow 类型；Optional[X] 按 X 处理 (Arrow 列本身可为空)。"""
+    args = [arg for arg in typing.get_args(annotation) if arg is not type(None)]
+    if typing.get_origin(annotation) in (typing.Union, types.UnionType) and len(args) == 1:
+        annotation = args[0]
+    if annotation is bool:
+        return pa.bool_()
+    if annotation is int:
+        return pa.int64()
+    if annotation is float:
+        return pa.float64()
+    return pa.string()
+
+def item_fields(schema):
+    return [(name, arrow_type(field.annotation)) for name, field in schema.ItemModel.model_fields.items()]
+
+def convert(value, arrow_t):
+    """把 CSV 中的字符串转换为对应类型的 Python 值，空字符串和无法解析的值转为 None。"""
+    if value is None or value == '':
+        return None
+    try:
+        if pa.types.is_boolean(arrow_t):
+            return {'true': True, 'false': False, '1': True, '0': False}.get(value.strip().lower())
+        if pa.types.is_integer(arrow_t):
+            return int(float(value))
+        if pa.types.is_floating(arrow_t):
+            return float(value)
+        if pa.types.is_timestamp(arrow_t):
+            return datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    return value
+
+def read_results(csv_path, fields):
+    """读取一个 results.csv，按 fields 转换类型，返回 Arrow Table。CSV 中缺失的列整列为 null。"""
+    columns = {name: [] for name, _ in fields}
+    with open(csv_path, mode='r', encoding='utf-8-sig', newline='') as f:
+        for row in csv.DictReader(f):
+            for name, arrow_t in fields:
+                columns[name].append(convert(row.get(name), arrow_t))
+    return pa.table({name: pa.array(columns[name], type=arrow_t) for name, arrow_t in fields})
+
+# results.sqlite 中的布尔列声明为 BOOLEAN，读取时直接转换为 bool
+sqlite3.register_converter("BOOLEAN", lambda value: value not in (b"0", b""))
+
+def load_results(directory):
+    """读取目录下 results.sqlite 中的结果，返回 dict 列表。
+
+    int / float / bool 列直接以对应的 Python 类型返回，缺失值为 None，不需要任何字符串解析。
+    """
+    conn = sqlite3.connect(os.path.join(directory, RESULTS_DB_NAME), detect_types=sqlite3.PARSE_DECLTYPES)
+    conn.row_factory = sqlite3.Row
+    try:
+        return [dict(row) for row in conn.execute("SELECT * FROM results ORDER BY rowid")]
+    finally:
+        conn.close()
+
+def table_from_results(rows, fields):
+    """把 load_results 的结果转换为 Arrow Table，只有 time 列需要从 ISO 字符串转换。"""
+    columns = {}
+    for name, arrow_t in fields:
+        values = [row.get(name) for row in rows]
+        if pa.types.is_timestamp(arrow_t):
+            values = [convert(value, arrow_t) for value in values]
+        columns[name] = pa.array(values, type=arrow_t)
+    return pa.table(columns)
+
+def partition_path(job_id):
+    return os.path.join(DATASET_DIR, f"job_id={job_id}", "part-0.parquet")
+
+def export_directory(directory):
+    """导出单个任务目录；结果文件和 schema.py 都比已有分区旧时跳过。返回导出的行数，跳过时返回 None。"""
+    job_id = os.path.basename(directory)
+    db_path = os.path.join(directory, RESULTS_DB_NAME)
+    source_path = db_path if os.path.exists(db_path) else os.path.join(directory, CSV_FILE_NAME)
+    schema = load_schema_module(directory)
+    if not schema or not os.path.exists(source_path):
+        return None
+
+    output_path = partition_path(job_id)
+    source_mtime = max(os.path.getmtime(source_path), os.path.getmtime(os.path.join(directory, "schema.py")))
+    if os.path.exists(output_path) and os.path.getmtime(output_path) >= source_mtime:
+        return None
+
+    base_names = {name for name, _ in BASE_FIELDS}
+    fields = BASE_FIELDS + [(name, t) for name, t in item_fields(schema) if name not in base_names]
+    if source_path == db_path:
+        table = table_from_results(load_results(directory), fields)
+    else:
+        table = read_results(source_path, fields)
+
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    temp_path = output_path + ".tmp"
+    pq.write_table(table, temp_path, compression=PARQUET_COMPRESSION)
+    os.replace(temp_path, output_path)
+    return table.num_rows
+
+def load_dataset(columns=None, job_ids=None):
+    """读取导出的数据集，返回 Arrow Table。
+
+    columns 为需要的列 (None 表示全部)，job_ids 为需要的任务目录 (None 表示全部)；
+    Parquet 按列存储，未选中的列和分区不会被读取。各分区的列不完全相同，
+    这里合并所有分区的 schema，某个分区没有的列读出为 null。
+    """
+    partitioning = ds.partitioning(pa.schema([('job_id', pa.string())]), flavor="hive")
+    dataset = ds.dataset(DATASET_DIR, format="parquet", partitioning=partitioning)
+    # 同名列在不同任务中类型不同时 (如 int 和 float) 按宽松规则提升为共同类型
+    unified = pa.unify_schemas([pq.read_schema(path) for path in dataset.files] +
+                               [pa.schema([('job_id', pa.string())])], promote_options="permissive")
+    dataset = ds.dataset(DATASET_DIR, format="parquet", partitioning=partitioning, schema=unified)
+    filter_expr = ds.field('job_id').isin([str(job_id) for job_id in job_ids]) if job_ids else None
+    return dataset.to_table(columns=columns, filter=filter_expr)
+
+def main():
+    exported = skipped = 0
+    for entry in sorted(os.listdir(ROOT_DIR)):
+        full_path = os.path.join(ROOT_DIR, entry)
+        if not os.path.isdir(full_path) or entry.startswith('.') or full_path == DATASET_DIR:
+            continue
+        try:
+            row_count = export_directory(full_path)
+        except Exception as e:
+            print(f"[{entry}] 导出失败: {e}")
+            continue
+        if row_count is None:
+            skipped += 1
+        else:
+            exported += 1
+            print(f"[{entry}] 导出 {row_count} 行")
+    print(f"\n导出完成: 更新 {exported} 个分区，跳过 {skipped} 个目录 -> {DATASET_DIR}")
+
+if __name__ == "__main__":
+    main()
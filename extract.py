@@ -1,23 +1,483 @@
 import os
+import io
 import csv
 import json
 import time
 import base64
+import random
+import re
+import hashlib
+import sqlite3
+import threading
+import types
+import typing
 import importlib.util
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import deque
 from datetime import datetime
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 
+import openai
+from pydantic import create_model
 from openai import OpenAI
+from openai.lib._parsing import type_to_response_format_param
+
+try:
+    from PIL import Image
+except ImportError: # 未安装 Pillow 时跳过图片预处理，按原图上传
+    Image = None
 
 # ================= 配置 =================
 MODEL_NAME = "gpt-5-mini"
+METADATA_FILE_NAME = "metadata.json" # spider 写出的精简元数据 (不含截图 Base64)
+LEGACY_DATA_FILE_NAME = "data.json" # 旧版内嵌截图 Base64 的数据文件
+MAX_WORKERS = 8 # 同时在途的模型请求数上限 (自适应并发的上界)
+INITIAL_CONCURRENCY = 4 # 自适应并发的初始值，之后根据限流情况自动增减
+MAX_ATTEMPTS = 5 # 单张图片调用模型的最大尝试次数 (限流、超时、5xx 会重试)
+BACKOFF_BASE = 2.0 # 指数退避的基础等待时间 (秒)
+BACKOFF_MAX = 60.0 # 单次退避等待的上限 (秒)
+RPM_LIMIT = None # 账户每分钟请求数上限；None 表示从响应头 x-ratelimit-limit-requests 获取
+TPM_LIMIT = None # 账户每分钟 token 数上限；None 表示从响应头 x-ratelimit-limit-tokens 获取
+RATE_HEADROOM = 0.9 # 只使用额度的这一比例，留出余量避免触发 429
+USE_BATCH_API = False # 大批量回填时改用 Batch API：整体提交、轮询完成后再写回 CSV
+BATCH_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".batches") # 批量请求文件和状态的目录
+BATCH_MAX_REQUESTS = 50000 # 单个批量文件的请求数上限 (Batch API 限制)
+BATCH_MAX_BYTES = 150 * 1024 * 1024 # 单个批量文件的大小上限，留出余量 (Batch API 限制 200MB)
+BATCH_POLL_INTERVAL = 30 # 轮询批次状态的间隔 (秒)
+USE_CACHE = True # 按 (图片内容, 模型, prompt, schema) 缓存模型的解析结果
+CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".extract_cache.sqlite")
+CACHE_MAX_BYTES = 512 * 1024 * 1024 # 缓存总大小上限，超出后按最近最少使用淘汰
+OUTPUT_BACKENDS = ("csv", "sqlite") # 结果写入的后端：csv 为 results.csv (供 results.pbix 使用)，sqlite 为按 ItemModel 生成类型化表的 results.sqlite
+RESULTS_DB_NAME = "results.sqlite" # sqlite 后端的数据库文件名 (每个任务目录一个)
+SCHEMA_MIGRATION = "report" # ItemModel 新增字段后如何处理旧结果："report" 只报告缺少新字段的图片，"reextract" 重新提取这些图片，"fields" 只为它们提取缺少的字段；schema.py 可覆盖
+PATCH_FIELDS = {} # 只重新提取部分字段并按文件名和排名写回现有结果，如 {"210": ["is_ad"]}；非空时 main 只处理这些目录
+CSV_REPLACE_SUFFIX = ".replace.jsonl" # 重新提取的图片的新行先写入 results.csv 旁的这个文件，结束时一次性替换旧行
+PROGRESS_FILE_NAME = ".progress.sqlite" # 每个任务目录下的提取进度索引 (逐图片状态、尝试次数、耗时、token)
+PREPROCESS_IMAGES = True # 上传前裁剪、缩放并重新压缩截图 (需要 Pillow)
+IMAGE_MAX_LONG_EDGE = 2048 # 长边上限；模型 high detail 本身也会先缩放到 2048x2048 以内
+IMAGE_MAX_SHORT_EDGE = 768 # 短边上限；high detail 会再把短边缩到 768，超出部分上传了也看不到
+IMAGE_JPEG_QUALITY = 85 # 重新压缩的 JPEG 质量
+IMAGE_CROP_TOP = 0.0 # 裁掉顶部的比例 (如状态栏约 0.03)，schema.py 可覆盖
+IMAGE_CROP_BOTTOM = 0.0 # 裁掉底部的比例 (如导航栏约 0.05)，schema.py 可覆盖
+IMAGE_DETAIL = "auto" # image_url 的 detail 参数："low" / "high" / "auto"，schema.py 可覆盖
+TILING = False # 把长截图切成有重叠的横条并发提取，再合并去重、重新计算排名；schema.py 可用 TILING = True 单独开启
+TILE_ASPECT = 1.0 # 每个横条的高度 = 图片宽度 x 该比例
+TILE_OVERLAP = 0.2 # 相邻横条重叠的比例，保证被切断的条目至少在一个横条里完整出现
+TILE_MIN_SCREENS = 1.5 # 图片高度超过一屏 (按元数据中参与者的 screen_width/screen_height 换算) 的这个倍数时才切分，普通单屏截图整图提取
+TILE_MIN_ASPECT = 3.0 # 没有屏幕尺寸元数据时，图片高宽比超过该值才切分 (普通手机截图约 2.0-2.2)
+IMAGES_PER_REQUEST = 1 # 每个请求打包的截图数；输出很短的 schema (如 SINGLE_ITEM) 可在 schema.py 中调大以分摊 prompt
+NEAR_DUPLICATES = False # 按感知哈希 (dHash) 把近似重复的截图分组，每组只调用一次模型，结果复制给组内其它截图；schema.py 可单独开启
+DHASH_SIZE = 16 # dHash 的边长，哈希共 DHASH_SIZE x DHASH_SIZE 位
+DHASH_THRESHOLD = 6 # 汉明距离不超过该值视为近似重复，schema.py 可覆盖
+NEAR_DUPLICATE_SAME_PARTICIPANT = True # 只在同一参与者的截图之间分组 (不同参与者看到的价格可能不同)
+NEAR_DUPLICATE_VERIFY_RATE = 0.05 # 抽检比例：这部分组员仍单独调用模型，并与组代表的结果比较
+FORCE_EXTRACT = [] # 始终单独提取、不参与近似重复分组的文件名，schema.py 可覆盖
+MULTI_IMAGE_PROMPT = "下面有多张截图，每张截图前一行给出它的文件名 (filename: ...)。请对每张截图分别按要求提取，results 中每张截图对应一项，filename 与给出的文件名完全一致。"
 # =======================================
 
 client = OpenAI()
 
-def encode_image(image_path):
+class ExtractionCache:
+    """基于 SQLite 的持久化提取缓存。
+
+    键由图片内容哈希、模型名、SYSTEM_PROMPT、USER_PROMPT_TEXT、ResponseModel 的
+    JSON schema 和图片预处理参数共同决定，值为模型返回的解析结果 (ResponseModel 的 JSON)。
+    修改 schema.py 或删除 CSV 重跑时，只有真正变化的组合才会再次调用模型。
+    总大小超过 max_bytes 时按 last_access 淘汰最旧的条目。多线程共享一个连接，用锁串行化。
+    """
+
+    def __init__(self, path=CACHE_PATH, max_bytes=CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            " key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL,"
+            " created_at REAL NOT NULL, last_access REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS cache_last_access ON cache (last_access)")
+        self.conn.commit()
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+        self.stats = {'hits': 0, 'misses': 0, 'writes': 0, 'evictions': 0}
+
+    @staticmethod
+    def make_key(schema, image_hash, model_name=MODEL_NAME, extra=None):
+        parts = [
+            image_hash,
+            model_name,
+            schema.SYSTEM_PROMPT,
+            schema.USER_PROMPT_TEXT,
+            schema.ResponseModel.model_json_schema(),
+            image_settings(schema),
+        ]
+        if extra is not None:
+            parts.append(extra)
+        return hashlib.sha256(json.dumps(parts, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.stats['misses'] += 1
+                return None
+            self.stats['hits'] += 1
+            self.conn.execute("UPDATE cache SET last_access = ? WHERE key = ?", (time.time(), key))
+            self.conn.commit()
+            return row[0]
+
+    def put(self, key, value):
+        size = len(value.encode('utf-8'))
+        now = time.time()
+        with self.lock:
+            old = self.conn.execute("SELECT size FROM cache WHERE key = ?", (key,)).fetchone()
+            self.conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, size, created_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, value, size, now, now),
+            )
+            self.total_bytes += size - (old[0] if old else 0)
+            self.stats['writes'] += 1
+            self._evict()
+            self.conn.commit()
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes:
+            rows = self.conn.execute(
+                "SELECT key, size FROM cache ORDER BY last_access LIMIT 100").fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                self.conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                self.total_bytes -= size
+                self.stats['evictions'] += 1
+                if self.total_bytes <= self.max_bytes:
+                    break
+
+    def report(self):
+        lookups = self.stats['hits'] + self.stats['misses']
+        hit_rate = self.stats['hits'] / lookups if lookups else 0.0
+        print(f"缓存统计: 命中 {self.stats['hits']}，未命中 {self.stats['misses']} (命中率 {hit_rate:.0%})，"
+              f"写入 {self.stats['writes']}，淘汰 {self.stats['evictions']}，"
+              f"当前大小 {self.total_bytes / 1024 / 1024:.1f} MB")
+
+cache = None # 由 open_cache() 在开始提取时创建；导入本模块 (如 bench.py) 不会创建缓存文件
+
+def open_cache():
+    """USE_CACHE 开启时创建全局提取缓存 (只创建一次) 并返回，关闭时返回 None。"""
+    global cache
+    if USE_CACHE and cache is None:
+        cache = ExtractionCache()
+    return cache
+
+def parse_duration(value):
+    """解析 x-ratelimit-reset-* 头中的时长，如 "1s"、"120ms"、"6m0s"，返回秒数。"""
+    if not value:
+        return None
+    seconds = 0.0
+    matched = False
+    for number, unit in re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", value):
+        matched = True
+        seconds += float(number) * {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}[unit]
+    return seconds if matched else None
+
+def retry_after_seconds(headers):
+    """从 retry-after-ms / retry-after 头中读取服务器建议的等待时间。"""
+    if headers is None:
+        return None
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        if headers.get('retry-after'):
+            return float(headers['retry-after'])
+    except ValueError:
+        pass
+    return None
+
+class AdaptiveLimiter:
+    """模型调用的自适应并发控制器。
+
+    - 并发上限按 AIMD 调整：每次成功加 1/limit (大约每轮 +1)，遇到 429 减半，
+      范围在 [1, max_limit] 之间；
+    - 按响应头 x-ratelimit-* 跟踪 RPM / TPM 额度：剩余额度耗尽时暂停到重置时间，
+      本地也按 60 秒滑动窗口统计请求数和 token 数，只使用 RATE_HEADROOM 比例的额度；
+    - 429 的 Retry-After 会让所有线程一起暂停。
+    """
+
+    def __init__(self, initial=INITIAL_CONCURRENCY, max_limit=MAX_WORKERS,
+                 rpm_limit=RPM_LIMIT, tpm_limit=TPM_LIMIT):
+        self.cond = threading.Condition()
+        self.limit = float(max(1, min(initial, max_limit)))
+        self.max_limit = max_limit
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.rpm_limit = rpm_limit
+        self.tpm_limit = tpm_limit
+        self.rpm_from_headers = rpm_limit is None
+        self.tpm_from_headers = tpm_limit is None
+        self.request_times = deque()
+        self.token_log = deque()
+        self.avg_tokens = None
+        self.stats = {'requests': 0, 'throttled': 0, 'errors': 0, 'retries': 0}
+
+    def _trim(self, now):
+        while self.request_times and now - self.request_times[0] >= 60:
+            self.request_times.popleft()
+        while self.token_log and now - self.token_log[0][0] >= 60:
+            self.token_log.popleft()
+
+    def _wait_time(self, now):
+        """距离可以发出下一个请求还需等待的秒数，0 表示可以立即发出。"""
+        if now < self.paused_until:
+            return self.paused_until - now
+        self._trim(now)
+        if self.rpm_limit and len(self.request_times) >= self.rpm_limit * RATE_HEADROOM:
+            return self.request_times[0] + 60 - now
+        if self.tpm_limit and self.avg_tokens:
+            used = sum(tokens for _, tokens in self.token_log) + self.in_flight * self.avg_tokens
+            if used + self.avg_tokens > self.tpm_limit * RATE_HEADROOM:
+                return (self.token_log[0][0] + 60 - now) if self.token_log else 1.0
+        return 0.0
+
+    def acquire(self):
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                wait = self._wait_time(now)
+                if wait <= 0 and self.in_flight < int(self.limit):
+                    break
+                self.cond.wait(timeout=wait if wait > 0 else None)
+            self.in_flight += 1
+            self.request_times.append(now)
+            self.stats['requests'] += 1
+
+    def _read_headers(self, headers, now):
+        try:
+            if self.rpm_from_headers and headers.get('x-ratelimit-limit-requests'):
+                self.rpm_limit = int(headers['x-ratelimit-limit-requests'])
+            if self.tpm_from_headers and headers.get('x-ratelimit-limit-tokens'):
+                self.tpm_limit = int(headers['x-ratelimit-limit-tokens'])
+            remaining_requests = headers.get('x-ratelimit-remaining-requests')
+            if remaining_requests is not None and int(remaining_requests) <= 0:
+                reset = parse_duration(headers.get('x-ratelimit-reset-requests')) or 1.0
+                self.paused_until = max(self.paused_until, now + reset)
+            remaining_tokens = headers.get('x-ratelimit-remaining-tokens')
+            if remaining_tokens is not None and self.avg_tokens and int(remaining_tokens) < self.avg_tokens:
+                reset = parse_duration(headers.get('x-ratelimit-reset-tokens')) or 1.0
+                self.paused_until = max(self.paused_until, now + reset)
+        except ValueError:
+            pass
+
+    def release(self, headers=None, tokens=None, outcome='success', retry_after=None):
+        """请求结束后调用。outcome 为 'success'、'throttled' (429) 或 'error'。"""
+        with self.cond:
+            now = time.monotonic()
+            self.in_flight -= 1
+            if tokens:
+                self.token_log.append((now, tokens))
+                self.avg_tokens = tokens if self.avg_tokens is None else 0.8 * self.avg_tokens + 0.2 * tokens
+            if headers is not None:
+                self._read_headers(headers, now)
+            if outcome == 'throttled':
+                self.stats['throttled'] += 1
+                self.limit = max(1.0, self.limit / 2)
+                self.paused_until = max(self.paused_until, now + (retry_after or 1.0))
+            elif outcome == 'error':
+                self.stats['errors'] += 1
+            else:
+                self.limit = min(float(self.max_limit), self.limit + 1.0 / self.limit)
+            self.cond.notify_all()
+
+    def report(self):
+        print(f"限流统计: 请求 {self.stats['requests']}，429 {self.stats['throttled']} 次，"
+              f"其它错误 {self.stats['errors']} 次，重试 {self.stats['retries']} 次，"
+              f"当前并发上限 {int(self.limit)}，RPM 上限 {self.rpm_limit}，TPM 上限 {self.tpm_limit}")
+
+limiter = AdaptiveLimiter()
+# 分块提取的横条请求在这个独立的线程池中执行，避免占用调度图片的线程池造成死锁；
+# 实际在途的请求数仍由 limiter 统一控制
+tile_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+
+# 当前线程累计的 token 用量，run_extraction 用它把 token 记到每张图片的进度上
+call_usage = threading.local()
+
+def add_usage(tokens):
+    call_usage.tokens = getattr(call_usage, 'tokens', 0) + (tokens or 0)
+
+def call_model(schema, messages, response_format=None):
+    """在自适应并发控制下调用模型，限流、超时和 5xx 错误按指数退避重试。
+
+    客户端自身的重试被关闭 (max_retries=0)，重试和等待统一由这里和 limiter 控制。
+    response_format 默认为 schema.ResponseModel。返回 ParsedChatCompletion。
+    """
+    for attempt in range(MAX_ATTEMPTS):
+        retry_after = None
+        limiter.acquire()
+        try:
+            raw = client.with_options(max_retries=0).beta.chat.completions.with_raw_response.parse(
+                model=MODEL_NAME,
+                messages=messages,
+                response_format=response_format or schema.ResponseModel,
+            )
+            response = raw.parse()
+        except openai.RateLimitError as e:
+            retry_after = retry_after_seconds(e.response.headers)
+            limiter.release(e.response.headers, outcome='throttled', retry_after=retry_after)
+            error = e
+        except (openai.APIConnectionError, openai.InternalServerError) as e:
+            limiter.release(outcome='error')
+            error = e
+        except Exception:
+            limiter.release(outcome='error')
+            raise
+        else:
+            usage = getattr(response, 'usage', None)
+            limiter.release(raw.headers, tokens=usage.total_tokens if usage else None)
+            add_usage(usage.total_tokens if usage else None)
+            return response
+
+        if attempt == MAX_ATTEMPTS - 1:
+            raise error
+        delay = retry_after if retry_after is not None else random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt)))
+        with limiter.cond:
+            limiter.stats['retries'] += 1
+        time.sleep(min(delay, BACKOFF_MAX))
+
+def image_settings(schema):
+    """当前 schema 生效的图片预处理参数，schema.py 中的同名属性优先于全局配置。
+
+    参数也参与缓存键，修改任意一项都会让相应图片重新调用模型。
+    """
+    return {
+        'preprocess': PREPROCESS_IMAGES and Image is not None,
+        'max_long_edge': getattr(schema, "IMAGE_MAX_LONG_EDGE", IMAGE_MAX_LONG_EDGE),
+        'max_short_edge': getattr(schema, "IMAGE_MAX_SHORT_EDGE", IMAGE_MAX_SHORT_EDGE),
+        'jpeg_quality': getattr(schema, "IMAGE_JPEG_QUALITY", IMAGE_JPEG_QUALITY),
+        'crop_top': getattr(schema, "IMAGE_CROP_TOP", IMAGE_CROP_TOP),
+        'crop_bottom': getattr(schema, "IMAGE_CROP_BOTTOM", IMAGE_CROP_BOTTOM),
+        'detail': getattr(schema, "IMAGE_DETAIL", IMAGE_DETAIL),
+    }
+
+def dhash(image_path, size=DHASH_SIZE):
+    """计算图片的差分哈希：缩成 (size+1) x size 的灰度图，比较每行相邻像素的明暗，返回整数。"""
+    with Image.open(image_path) as img:
+        img = img.convert("L").resize((size + 1, size), Image.LANCZOS)
+        pixels = img.tobytes()
+    value = 0
+    for row in range(size):
+        for col in range(size):
+            left = pixels[row * (size + 1) + col]
+            right = pixels[row * (size + 1) + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count("1")
+
+def preprocess_image(image_bytes, settings, band=None):
+    """按 settings 裁掉状态栏/导航栏、等比缩小并重新压缩为 JPEG，返回新的字节。
+
+    band 为 (top, bottom) 时只保留这一横条 (分块提取用)，此时忽略 crop_top/crop_bottom。
+    图片本来就够小、也不需要裁剪，且重新压缩后并没有变小时，原样返回。
+    """
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        img = img.convert("RGB")
+        width, height = img.size
+        if band:
+            top, bottom = band
+        else:
+            top = int(height * settings['crop_top'])
+            bottom = height - int(height * settings['crop_bottom'])
+        changed = False
+        if top > 0 or bottom < height:
+            img = img.crop((0, top, width, bottom))
+            height = bottom - top
+            changed = True
+        scale = 1.0
+        if settings['max_long_edge']:
+            scale = min(scale, settings['max_long_edge'] / max(width, height))
+        if settings['max_short_edge']:
+            scale = min(scale, settings['max_short_edge'] / min(width, height))
+        if scale < 1.0:
+            img = img.resize((max(1, round(width * scale)), max(1, round(height * scale))), Image.LANCZOS)
+            changed = True
+        buffer = io.BytesIO()
+        img.save(buffer, format="JPEG", quality=settings['jpeg_quality'], optimize=True)
+    data = buffer.getvalue()
+    if not changed and len(data) >= len(image_bytes):
+        return image_bytes
+    return data
+
+def tiling_settings(schema):
+    """当前 schema 生效的分块参数；未开启分块 (或 SINGLE_ITEM、未安装 Pillow) 时返回 None。"""
+    if not getattr(schema, "TILING", TILING) or getattr(schema, "SINGLE_ITEM", False) or Image is None:
+        return None
+    return {
+        'tile_aspect': getattr(schema, "TILE_ASPECT", TILE_ASPECT),
+        'tile_overlap': getattr(schema, "TILE_OVERLAP", TILE_OVERLAP),
+        'tile_min_screens': getattr(schema, "TILE_MIN_SCREENS", TILE_MIN_SCREENS),
+        'tile_min_aspect': getattr(schema, "TILE_MIN_ASPECT", TILE_MIN_ASPECT),
+    }
+
+def screen_aspect(metadata):
+    """元数据中参与者屏幕的高宽比 (长边 / 短边)；缺少或无法解析屏幕尺寸时返回 None。"""
+    try:
+        sides = sorted((float(metadata['screen_width']), float(metadata['screen_height'])))
+    except (KeyError, TypeError, ValueError):
+        return None
+    return sides[1] / sides[0] if sides[0] > 0 else None
+
+def image_bands(image_bytes, schema, tiling, metadata=None):
+    """计算长截图的横条切分位置，返回 [(top, bottom), ...]；图片不够长时返回 None。
+
+    只切分滚动拼接的长截图：图片的高宽比要超过参与者屏幕 (metadata 中的 screen_width/screen_height)
+    的 tile_min_screens 倍，按比例比较，截图被缩放过也不影响；没有屏幕尺寸时要求高宽比超过
+    tile_min_aspect。普通的单屏截图整图提取。
+    先去掉 crop_top/crop_bottom 对应的状态栏和导航栏，再在剩余区域内均匀排布横条，
+    相邻横条至少重叠 tile_overlap。
+    """
+    settings = image_settings(schema)
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        width, height = img.size
+    aspect = screen_aspect(metadata or {})
+    min_aspect = aspect * tiling['tile_min_screens'] if aspect else tiling['tile_min_aspect']
+    if width <= 0 or height / width <= min_aspect:
+        return None
+    top = int(height * settings['crop_top'])
+    bottom = height - int(height * settings['crop_bottom'])
+    content_height = bottom - top
+    tile_height = int(width * tiling['tile_aspect'])
+    if tile_height <= 0 or content_height <= tile_height:
+        return None
+    step = tile_height * (1 - tiling['tile_overlap'])
+    count = int(-(-(content_height - tile_height) // step)) + 1
+    stride = (content_height - tile_height) / (count - 1)
+    return [(top + round(i * stride), top + round(i * stride) + tile_height) for i in range(count)]
+
+def read_image(image_path, schema=None):
+    """读取图片，返回 (上传用的 Base64 字符串, 原图内容 sha256)。
+
+    传入 schema 且启用预处理时，Base64 是预处理后的图片；哈希始终基于原图，
+    预处理参数另外计入缓存键。
+    """
     with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode('utf-8')
+        image_bytes = image_file.read()
+    image_hash = hashlib.sha256(image_bytes).hexdigest()
+    if schema is not None:
+        settings = image_settings(schema)
+        if settings['preprocess']:
+            try:
+                image_bytes = preprocess_image(image_bytes, settings)
+            except Exception as e:
+                print(f"  -> 图片预处理失败，改用原图: {os.path.basename(image_path)}: {e}")
+    return base64.b64encode(image_bytes).decode('utf-8'), image_hash
+
+def cached_items(schema, cache_key):
+    """缓存命中时返回 ItemModel 列表，否则返回 None。"""
+    if cache is None:
+        return None
+    value = cache.get(cache_key)
+    if value is None:
+        return None
+    return items_from_parsed(schema, schema.ResponseModel.model_validate_json(value))
 
 def load_metadata_from_json(json_path):
     """通用元数据加载逻辑"""
@@ -54,19 +514,249 @@ def load_metadata_from_json(json_path):
         print(f"元数据加载警告: {e}")
     return metadata_map
 
-def get_processed_files(csv_file_path):
-    """断点续传检查"""
-    if not os.path.exists(csv_file_path):
-        return set()
-    processed = set()
-    try:
-        with open(csv_file_path, mode='r', encoding='utf-8-sig') as f:
+def schema_version(schema):
+    """ItemModel 的版本号：字段名、类型和可空性 (JSON schema) 的哈希。只改 prompt 不会改变版本。"""
+    value = json.dumps(schema.ItemModel.model_json_schema(), sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(value.encode('utf-8')).hexdigest()[:12]
+
+def read_csv_header(csv_path):
+    if not os.path.exists(csv_path):
+        return None
+    with open(csv_path, mode='r', encoding='utf-8-sig', newline='') as f:
+        return next(csv.reader(f), None)
+
+def merge_csv_replacements(csv_path, keep=None):
+    """把替换文件中重新提取的图片的行合并回 CSV：删除这些图片的旧行、追加新行，然后删除替换文件。
+
+    替换文件每行是一张图片的 {"filename", "rows"}，同一图片以最后一行为准；崩溃时只写了一半的
+    最后一行无法解析，直接跳过。keep 不为 None 时只合并其中的文件名 (已完成的图片)。
+    合并结果与替换文件是否已合并过无关，重写 CSV 后、删除替换文件前崩溃也可以再次合并。
+    返回合并的图片数。
+    """
+    replace_path = csv_path + CSV_REPLACE_SUFFIX
+    if not os.path.exists(replace_path):
+        return 0
+    replacements = {}
+    with open(replace_path, mode='r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if keep is None or entry['filename'] in keep:
+                replacements[entry['filename']] = entry['rows']
+    if replacements:
+        temp_path = csv_path + ".tmp"
+        with open(csv_path, mode='r', encoding='utf-8-sig', newline='') as src, \
+                open(temp_path, mode='w', encoding='utf-8-sig', newline='') as dst:
+            reader = csv.DictReader(src)
+            writer = csv.DictWriter(dst, fieldnames=reader.fieldnames, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(row for row in reader if row['filename'] not in replacements)
+            for rows in replacements.values():
+                writer.writerows(rows)
+        os.replace(temp_path, csv_path)
+    os.remove(replace_path)
+    return len(replacements)
+
+class ProgressIndex:
+    """单个任务目录的提取进度索引，保存在目录下的 .progress.sqlite 中。
+
+    每张图片一行：status (pending / in-flight / done / failed)、尝试次数、平均耗时、token 用量
+    和最后一次错误。CSV 行先写入并 flush，随后才把图片标记为 done 并提交，因此中途崩溃时
+    CSV 中可能残留部分写入的行，但它们对应的图片不会被当作已完成。写入期间 meta 表中的
+    dirty 标记为 1；启动时发现 dirty 或遗留的 in-flight 图片，就按索引重写 CSV，删掉从未完成过的图片的行。
+    等待重新提取的图片 (曾经完成、记录了 schema 版本) 保留旧行，直到新结果写入时被整体替换。
+    首次使用时从现有 results.csv 导入已处理的图片，全部按已完成处理，不删除任何行。
+    主输出文件 (output_path，默认即 results.csv) 不存在时清空索引。
+    每张图片还记录产生其结果的 schema 版本，versions 表保存每个版本包含的字段，
+    用于找出 ItemModel 新增字段之前提取的图片。
+    """
+
+    def __init__(self, directory, csv_path, output_path=None):
+        self.csv_path = csv_path
+        self.lock = threading.Lock()
+        path = os.path.join(directory, PROGRESS_FILE_NAME)
+        is_new = not os.path.exists(path)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS images ("
+            " filename TEXT PRIMARY KEY, status TEXT NOT NULL DEFAULT 'pending',"
+            " attempts INTEGER NOT NULL DEFAULT 0, item_count INTEGER, latency REAL, tokens REAL,"
+            " error TEXT, updated_at REAL)"
+        )
+        if 'schema_version' not in {row[1] for row in self.conn.execute("PRAGMA table_info(images)")}:
+            self.conn.execute("ALTER TABLE images ADD COLUMN schema_version TEXT")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS images_status ON images (status)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS versions (version TEXT PRIMARY KEY, fields TEXT NOT NULL, created_at REAL)")
+        self.conn.commit()
+
+        self.cleared = False # 本次是否因主输出被删除而清空了已有的索引
+        if not os.path.exists(output_path or csv_path):
+            # 主输出文件被删除 (例如要整体重跑)，索引随之清空
+            self.cleared = self.conn.execute("SELECT 1 FROM images LIMIT 1").fetchone() is not None
+            self.conn.execute("DELETE FROM images")
+            self.set_dirty(False)
+        elif is_new and os.path.exists(csv_path):
+            self.seed_from_csv()
+        in_flight = self.conn.execute("SELECT 1 FROM images WHERE status = 'in-flight' LIMIT 1").fetchone()
+        if os.path.exists(csv_path) and (self.is_dirty() or in_flight):
+            self.repair_csv()
+
+    def is_dirty(self):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'dirty'").fetchone()
+        return bool(row and row[0] == '1')
+
+    def set_dirty(self, dirty):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('dirty', ?)", ('1' if dirty else '0',))
+            self.conn.commit()
+
+    def seed_from_csv(self):
+        """从旧版 results.csv 导入已处理的图片，全部标记为 done。
+
+        旧版脚本每张图片写完即 flush，无法判断最后一张是否只写了一部分；
+        与其删掉它的行 (而图片可能早已不在目录中，无法重新提取)，不如原样保留。
+        """
+        filenames = []
+        with open(self.csv_path, mode='r', encoding='utf-8-sig') as f:
             reader = csv.reader(f)
             next(reader, None) # 跳过表头
             for row in reader:
-                if row: processed.add(row[0])
-    except: pass
-    return processed
+                if row and (not filenames or filenames[-1] != row[0]):
+                    filenames.append(row[0])
+        now = time.time()
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO images (filename, status, updated_at) VALUES (?, 'done', ?)",
+            [(name, now) for name in filenames],
+        )
+        self.conn.commit()
+        print(f"已从 results.csv 导入 {len(filenames)} 张图片的进度。")
+
+    def repair_csv(self):
+        """按索引重写 CSV，删掉从未完成过的图片的 (部分写入的) 行，并把未完成的图片恢复为 pending。
+
+        曾经完成过的图片 (有 schema_version) 即使正在重新提取，CSV 中也是完整的旧行，予以保留；
+        它们已完成的新行在替换文件中，先合并回 CSV (见 merge_csv_replacements)。
+        """
+        finished = {row[0] for row in self.conn.execute("SELECT filename FROM images WHERE status = 'done'")}
+        merged = merge_csv_replacements(self.csv_path, finished)
+        if merged:
+            print(f"已把 {merged} 张重新提取完成的图片的新行合并回 results.csv。")
+        done = {row[0] for row in self.conn.execute(
+            "SELECT filename FROM images WHERE status = 'done' OR schema_version IS NOT NULL")}
+        temp_path = self.csv_path + ".tmp"
+        removed = 0
+        with open(self.csv_path, mode='r', encoding='utf-8-sig', newline='') as src, \
+                open(temp_path, mode='w', encoding='utf-8-sig', newline='') as dst:
+            reader = csv.reader(src)
+            writer = csv.writer(dst)
+            header = next(reader, None)
+            if header:
+                writer.writerow(header)
+            for row in reader:
+                if row and row[0] in done:
+                    writer.writerow(row)
+                elif row:
+                    removed += 1
+        os.replace(temp_path, self.csv_path)
+        self.conn.execute("UPDATE images SET status = 'pending' WHERE status = 'in-flight'")
+        self.conn.commit()
+        self.set_dirty(False)
+        print(f"已从 results.csv 中删除 {removed} 行未完成图片的数据。")
+
+    def sync(self, filenames):
+        """登记目录中新出现的图片，返回尚未完成的文件名 (按文件名排序)。"""
+        with self.lock:
+            self.conn.executemany("INSERT OR IGNORE INTO images (filename) VALUES (?)", ((f,) for f in filenames))
+            self.conn.commit()
+            pending = [row[0] for row in self.conn.execute(
+                "SELECT filename FROM images WHERE status != 'done' ORDER BY filename")]
+        existing = set(filenames)
+        return [f for f in pending if f in existing]
+
+    def start(self, filenames):
+        with self.lock:
+            self.conn.executemany(
+                "UPDATE images SET status = 'in-flight', attempts = attempts + 1, updated_at = ? WHERE filename = ?",
+                ((time.time(), f) for f in filenames),
+            )
+            self.conn.commit()
+
+    def finish(self, filename, item_count, latency=None, tokens=None, version=None):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO images"
+                " (filename, status, attempts, item_count, latency, tokens, error, updated_at, schema_version)"
+                " VALUES (?, 'done', COALESCE((SELECT attempts FROM images WHERE filename = ?), 0), ?, ?, ?, NULL, ?, ?)",
+                (filename, filename, item_count, latency, tokens, time.time(), version),
+            )
+            self.conn.commit()
+
+    def register_version(self, version, fields):
+        with self.lock:
+            self.conn.execute("INSERT OR IGNORE INTO versions (version, fields, created_at) VALUES (?, ?, ?)",
+                              (version, json.dumps(list(fields)), time.time()))
+            self.conn.commit()
+
+    def assign_legacy_version(self, fields):
+        """没有版本记录的已完成图片 (从 CSV 导入或早于版本记录) 按 CSV 表头中的字段登记一个版本。"""
+        if not self.conn.execute(
+                "SELECT 1 FROM images WHERE status = 'done' AND schema_version IS NULL LIMIT 1").fetchone():
+            return
+        version = "csv-" + hashlib.sha256(json.dumps(list(fields)).encode('utf-8')).hexdigest()[:12]
+        self.register_version(version, fields)
+        with self.lock:
+            self.conn.execute("UPDATE images SET schema_version = ? WHERE status = 'done' AND schema_version IS NULL",
+                              (version,))
+            self.conn.commit()
+
+    def stale_images(self, fields):
+        """返回 {文件名: 缺少的字段元组}，只包含结果由缺少 fields 中某些字段的旧版本产生的图片。"""
+        version_fields = {version: set(json.loads(value))
+                          for version, value in self.conn.execute("SELECT version, fields FROM versions")}
+        stale = {}
+        for filename, version in self.conn.execute(
+                "SELECT filename, schema_version FROM images WHERE status = 'done' AND schema_version IS NOT NULL"):
+            missing = tuple(f for f in fields if f not in version_fields.get(version, fields))
+            if missing:
+                stale[filename] = missing
+        return stale
+
+    def done_images(self):
+        return [row[0] for row in self.conn.execute(
+            "SELECT filename FROM images WHERE status = 'done' ORDER BY filename")]
+
+    def set_version(self, filenames, version):
+        with self.lock:
+            self.conn.executemany("UPDATE images SET schema_version = ? WHERE filename = ?",
+                                  ((version, f) for f in filenames))
+            self.conn.commit()
+
+    def reset(self, filenames):
+        """把图片恢复为 pending，下次调度时重新提取。结果中的旧行保留，直到新结果写入时被替换。"""
+        with self.lock:
+            self.conn.executemany("UPDATE images SET status = 'pending' WHERE filename = ?", ((f,) for f in filenames))
+            self.conn.commit()
+
+    def fail(self, filename, error):
+        with self.lock:
+            self.conn.execute(
+                "UPDATE images SET status = 'failed', error = ?, updated_at = ? WHERE filename = ?",
+                (str(error)[:500], time.time(), filename),
+            )
+            self.conn.commit()
+
+    def report(self):
+        counts = dict(self.conn.execute("SELECT status, COUNT(*) FROM images GROUP BY status").fetchall())
+        latency, tokens = self.conn.execute(
+            "SELECT AVG(latency), SUM(tokens) FROM images WHERE status = 'done' AND latency IS NOT NULL").fetchone()
+        summary = "，".join(f"{status} {count}" for status, count in sorted(counts.items()))
+        if latency is not None:
+            summary += f"，平均耗时 {latency:.2f}s，token 合计 {int(tokens or 0)}"
+        return summary
 
 def load_schema_module(directory):
     """动态加载子目录下的 schema.py 模块"""
@@ -79,126 +769,1113 @@ def load_schema_module(directory):
     spec.loader.exec_module(module)
     return module
 
-def process_directory(directory):
-    """处理单个子目录的核心逻辑"""
-    
-    # 1. 动态加载该目录的配置 (Schema)
-    schema = load_schema_module(directory)
-    if not schema:
-        return
+def build_messages(schema, base64_img):
+    """构建单张图片的对话消息，实时调用和 Batch API 共用。"""
+    return [
+        {"role": "system", "content": schema.SYSTEM_PROMPT},
+        {
+            "role": "user", 
+            "content": [
+                {"type": "text", "text": schema.USER_PROMPT_TEXT},
+                {"type": "image_url", "image_url": {
+                    "url": f"data:image/jpeg;base64,{base64_img}",
+                    "detail": image_settings(schema)['detail'],
+                }}
+            ]
+        },
+    ]
 
-    print(f"\n======== 正在处理任务目录: {os.path.basename(directory)} ========")
-    
-    # 路径定义
-    json_data_file = os.path.join(directory, 'data.json')
-    output_csv = os.path.join(directory, "results.csv")
-    
-    # 2. 加载元数据
-    metadata_map = load_metadata_from_json(json_data_file)
-    
-    # 3. 获取图片列表
-    all_files = [f for f in os.listdir(directory) if f.lower().endswith(('.jpg', '.jpeg', '.png'))]
-    all_files.sort()
-    
-    processed_files = get_processed_files(output_csv)
-    print(f"发现 {len(all_files)} 张图片，已处理 {len(processed_files)} 张。")
+def items_from_parsed(schema, parsed_result):
+    """从解析后的 ResponseModel 中取出 ItemModel 列表。"""
+    items_list = getattr(parsed_result, schema.LIST_FIELD_NAME, [])
+    if getattr(schema, "SINGLE_ITEM",False):
+        items_list=[items_list]
+    return items_list or []
+
+def same_value(a, b):
+    if isinstance(a, str) and isinstance(b, str):
+        return a.strip().lower() == b.strip().lower()
+    if isinstance(a, float) or isinstance(b, float):
+        return abs(a - b) < 1e-6
+    return a == b
+
+def same_item(a, b, fields):
+    """两个横条里的条目是否为同一条：双方都有值的字段全部相同，且其中至少有一个非布尔字段。
 
-    # 4. 确定 CSV 表头 (关键修改部分)
-    # 4.1 计算当前代码逻辑期望的完整字段列表
-    base_fieldnames = ['filename', 'time', 'participant_id', 'device_model','android_version', 'screen_width', 'screen_height']
-    schema_fieldnames = list(schema.ItemModel.model_fields.keys())
-    expected_fieldnames = base_fieldnames + schema_fieldnames
+    被横条边缘切断的条目常常缺少部分字段 (null)，因此只比较双方都识别出来的字段。
+    """
+    identifying = False
+    for field in fields:
+        value_a, value_b = getattr(a, field, None), getattr(b, field, None)
+        if value_a is None or value_b is None:
+            continue
+        if not same_value(value_a, value_b):
+            return False
+        if not isinstance(value_a, bool):
+            identifying = True
+    return identifying
 
-    # 4.2 检查文件是否存在，如果存在，读取它实际的表头顺序
-    final_fieldnames = expected_fieldnames
-    file_exists = os.path.exists(output_csv)
+def identity_fields(schema):
+    """横条合并时用来识别同一条目的字段：TILE_DEDUPE_FIELDS，未指定时为排名以外的文本字段 (如 product_name)。"""
+    fields = getattr(schema, "TILE_DEDUPE_FIELDS", None)
+    if fields:
+        return list(fields)
+    rank_field = getattr(schema, "RANK_FIELD", "rank")
+    return [name for name, field in schema.ItemModel.model_fields.items()
+            if name != rank_field and str in (field.annotation, *typing.get_args(field.annotation))]
 
-    if file_exists:
+def filled_fields(item, fields):
+    return sum(getattr(item, field, None) is not None for field in fields)
+
+def merge_tile_items(schema, tile_items):
+    """按从上到下的顺序合并各横条的条目，去掉重叠区域里的重复项，并重新计算全局排名。
+
+    重复只在相邻横条之间查找；同一条目出现两次时保留字段更完整的那个。
+    排名字段默认为 rank，schema.py 可用 RANK_FIELD 指定 (如 position)，
+    用于去重比较的字段可用 TILE_DEDUPE_FIELDS 指定，默认为排名以外的所有字段。
+    """
+    model_fields = list(schema.ItemModel.model_fields.keys())
+    rank_field = getattr(schema, "RANK_FIELD", "rank")
+    if rank_field not in model_fields:
+        rank_field = None
+    fields = getattr(schema, "TILE_DEDUPE_FIELDS", None) or [f for f in model_fields if f != rank_field]
+
+    merged = []
+    candidates = [] # 上一个横条中尚未被匹配的条目在 merged 中的下标
+    for items in tile_items:
+        if rank_field:
+            items = sorted(items, key=lambda item: getattr(item, rank_field) or 0)
+        current = []
+        for item in items:
+            match = next((i for i, index in enumerate(candidates) if same_item(merged[index], item, fields)), None)
+            if match is None:
+                merged.append(item)
+                current.append(len(merged) - 1)
+                continue
+            index = candidates.pop(match)
+            if filled_fields(item, fields) > filled_fields(merged[index], fields):
+                merged[index] = item
+            current.append(index)
+        candidates = current
+
+    if rank_field:
+        merged = [item.model_copy(update={rank_field: i + 1}) for i, item in enumerate(merged)]
+    return merged
+
+def extract_tiles(schema, image_bytes, bands):
+    """把各横条作为独立请求并发提交，按横条顺序返回合并后的 ResponseModel。"""
+    settings = image_settings(schema)
+
+    def extract_band(band):
+        tile_bytes = preprocess_image(image_bytes, settings, band)
+        base64_tile = base64.b64encode(tile_bytes).decode('utf-8')
+        response = call_model(schema, build_messages(schema, base64_tile))
+        usage = getattr(response, 'usage', None)
+        return items_from_parsed(schema, response.choices[0].message.parsed), usage.total_tokens if usage else 0
+
+    results = list(tile_executor.map(extract_band, bands))
+    # 横条在其它线程中调用模型，token 用量记回当前线程
+    add_usage(sum(tokens for _, tokens in results))
+    tile_items = [items for items, _ in results]
+    merged = merge_tile_items(schema, tile_items)
+    return schema.ResponseModel.model_validate({schema.LIST_FIELD_NAME: merged})
+
+def extract_items(schema, file_path, metadata=None):
+    """对单张图片调用模型，返回解析出的 ItemModel 列表 (可能为空)。
+
+    只负责模型调用，不写文件，因此可以在多个线程中并发执行。
+    相同图片、模型、prompt 和 schema 的组合直接从缓存返回。
+    开启分块的 schema 遇到长截图时，按横条并发提取后合并 (见 merge_tile_items)；
+    metadata 为该图片的元数据，用其中的屏幕尺寸判断是否为长截图 (见 image_bands)。
+    """
+    tiling = tiling_settings(schema)
+    bands = None
+    if tiling:
+        with open(file_path, "rb") as image_file:
+            image_bytes = image_file.read()
+        image_hash = hashlib.sha256(image_bytes).hexdigest()
         try:
-            with open(output_csv, mode='r', encoding='utf-8-sig') as f:
-                reader = csv.reader(f)
-                existing_header = next(reader, None)
+            bands = image_bands(image_bytes, schema, tiling, metadata)
+        except Exception as e:
+            print(f"  -> 无法计算分块，改为整图提取: {os.path.basename(file_path)}: {e}")
+    if bands:
+        cache_key = ExtractionCache.make_key(schema, image_hash, extra=tiling)
+    else:
+        base64_img, image_hash = read_image(file_path, schema)
+        cache_key = ExtractionCache.make_key(schema, image_hash)
+    items_list = cached_items(schema, cache_key)
+    if items_list is not None:
+        return items_list
+
+    # === 核心调用 ===
+    if bands:
+        parsed_result = extract_tiles(schema, image_bytes, bands)
+    else:
+        response = call_model(schema, build_messages(schema, base64_img))
+        parsed_result = response.choices[0].message.parsed
+    if cache is not None and parsed_result is not None:
+        cache.put(cache_key, parsed_result.model_dump_json())
+    return items_from_parsed(schema, parsed_result)
+
+def images_per_request(schema):
+    """当前 schema 每个请求打包的截图数；开启分块的 schema 始终逐张提取。"""
+    if tiling_settings(schema):
+        return 1
+    return max(1, int(getattr(schema, "IMAGES_PER_REQUEST", IMAGES_PER_REQUEST)))
+
+multi_image_models = {}
+
+def multi_image_model(schema):
+    """用 create_model 生成多图请求的响应模型：results 中每项为 filename 加上该图的提取结果。
+
+    每项的结果字段与 ResponseModel 的 LIST_FIELD_NAME 字段同名、同类型，
+    因此可以直接拆回单张图片的 ResponseModel。按 ResponseModel 缓存生成的模型。
+    """
+    model = multi_image_models.get(schema.ResponseModel)
+    if model is None:
+        list_field = schema.ResponseModel.model_fields[schema.LIST_FIELD_NAME]
+        file_result = create_model(
+            "FileResult",
+            filename=(str, ...),
+            **{schema.LIST_FIELD_NAME: (list_field.annotation, ...)},
+        )
+        model = create_model("MultiImageResponse", results=(List[file_result], ...))
+        multi_image_models[schema.ResponseModel] = model
+    return model
+
+def build_multi_messages(schema, images):
+    """构建多张图片的对话消息，images 为 [(文件名, Base64), ...]，每张图片前附一行文件名。"""
+    detail = image_settings(schema)['detail']
+    content = [{"type": "text", "text": f"{schema.USER_PROMPT_TEXT}\n{MULTI_IMAGE_PROMPT}"}]
+    for filename, base64_img in images:
+        content.append({"type": "text", "text": f"filename: {filename}"})
+        content.append({"type": "image_url", "image_url": {
+            "url": f"data:image/jpeg;base64,{base64_img}",
+            "detail": detail,
+        }})
+    return [
+        {"role": "system", "content": schema.SYSTEM_PROMPT},
+        {"role": "user", "content": content},
+    ]
+
+def extract_group(schema, directory, filenames, metadata_map=None):
+    """把同一目录的多张截图打包进一个请求，返回 {文件名: ItemModel 列表或异常}。
+
+    缓存按单张图片保存 (键中包含打包数量)，命中的图片不再进入请求。
+    模型漏掉的文件名单独重新提取一次。metadata_map 为目录的元数据，逐张提取时传给 extract_items。
+    """
+    metadata_map = metadata_map or {}
+    if len(filenames) == 1:
+        filename = filenames[0]
+        return {filename: extract_items(schema, os.path.join(directory, filename), metadata_map.get(filename))}
+
+    extra = {'images_per_request': images_per_request(schema)}
+    results = {}
+    images = []
+    cache_keys = {}
+    for filename in filenames:
+        base64_img, image_hash = read_image(os.path.join(directory, filename), schema)
+        cache_keys[filename] = ExtractionCache.make_key(schema, image_hash, extra=extra)
+        items_list = cached_items(schema, cache_keys[filename])
+        if items_list is not None:
+            results[filename] = items_list
+        else:
+            images.append((filename, base64_img))
+    if not images:
+        return results
+
+    response = call_model(schema, build_multi_messages(schema, images), multi_image_model(schema))
+    parsed = response.choices[0].message.parsed
+    by_name = {result.filename.strip(): result for result in (parsed.results if parsed else [])}
+    for filename, _ in images:
+        result = by_name.get(filename)
+        if result is None:
+            try:
+                results[filename] = extract_items(schema, os.path.join(directory, filename),
+                                                  metadata_map.get(filename))
+            except Exception as e:
+                results[filename] = e
+            continue
+        parsed_result = schema.ResponseModel.model_validate(
+            {schema.LIST_FIELD_NAME: getattr(result, schema.LIST_FIELD_NAME)})
+        if cache is not None:
+            cache.put(cache_keys[filename], parsed_result.model_dump_json())
+        results[filename] = items_from_parsed(schema, parsed_result)
+    return results
+
+def rank_field_of(schema):
+    """列表型 schema 中用于对齐各行的排名字段；SINGLE_ITEM 或没有排名字段时返回 None (按顺序对齐)。"""
+    rank_field = getattr(schema, "RANK_FIELD", "rank")
+    if getattr(schema, "SINGLE_ITEM", False) or rank_field not in schema.ItemModel.model_fields:
+        return None
+    return rank_field
+
+def reduce_prompt(system_prompt, item_fields, keep):
+    """从 SYSTEM_PROMPT 中去掉不需要的字段说明行 (" 字段 : 说明" 形式)，其它说明保持不变。"""
+    lines = []
+    for line in system_prompt.splitlines():
+        match = re.match(r"\s*(\w+)\s*:", line)
+        if match and match.group(1) in item_fields and match.group(1) not in keep:
+            continue
+        lines.append(line)
+    return "\n".join(lines)
+
+class PatchSchema:
+    """只提取部分字段的 schema：ItemModel、ResponseModel 和 SYSTEM_PROMPT 只保留指定字段 (以及排名字段)，
+    其余属性 (USER_PROMPT_TEXT、LIST_FIELD_NAME、图片预处理设置等) 沿用原 schema。
+
+    schema.py 中 ITEM_FILTER_FIELDS 列出的字段 (ITEM_FILTERS 要读取的字段) 也保留，
+    补提取的条目才能按同样的规则过滤、重新编号排名。
+    原 schema 开启分块时长截图照常分块提取：模型中另外保留去重用的识别字段 (见 identity_fields)，
+    merge_tile_items 才能合并重叠的条目，排名与完整提取时一致；这些字段不会写回结果。
+    可以直接交给 extract_items / extract_group，缓存键也随之不同。
+    """
+
+    def __init__(self, schema, fields):
+        self.base = schema
+        model_fields = schema.ItemModel.model_fields
+        unknown = [f for f in fields if f not in model_fields]
+        if unknown:
+            raise ValueError(f"ItemModel 中没有这些字段: {', '.join(unknown)}")
+        rank_field = rank_field_of(schema)
+        keep = ([rank_field] if rank_field else []) + list(fields) + list(getattr(schema, "ITEM_FILTER_FIELDS", []))
+        if tiling_settings(schema):
+            keep += identity_fields(schema)
+        keep = [f for f in model_fields if f in keep]
+        self.fields = list(fields)
+        self.ItemModel = create_model(
+            "PatchItemModel", **{name: (model_fields[name].annotation, ...) for name in keep})
+        list_annotation = schema.ResponseModel.model_fields[schema.LIST_FIELD_NAME].annotation
+        if getattr(schema, "SINGLE_ITEM", False):
+            list_type = Optional[self.ItemModel] if type(None) in typing.get_args(list_annotation) else self.ItemModel
+        else:
+            list_type = List[self.ItemModel]
+        self.ResponseModel = create_model("PatchResponseModel", **{schema.LIST_FIELD_NAME: (list_type, ...)})
+        self.SYSTEM_PROMPT = reduce_prompt(schema.SYSTEM_PROMPT, model_fields, keep)
+
+    def __getattr__(self, name):
+        return getattr(self.base, name)
+
+def sqlite_type(annotation):
+    """ItemModel 字段类型对应的 SQLite 列类型；Optional[X] 按 X 处理 (列本身允许 NULL)。"""
+    args = [arg for arg in typing.get_args(annotation) if arg is not type(None)]
+    if typing.get_origin(annotation) in (typing.Union, types.UnionType) and len(args) == 1:
+        annotation = args[0]
+    if annotation is bool:
+        return "BOOLEAN"
+    if annotation is int:
+        return "INTEGER"
+    if annotation is float:
+        return "REAL"
+    return "TEXT"
+
+class CsvResultWriter:
+    """results.csv 写入器。已有文件时沿用其表头顺序；schema 新增的字段在第一次写入或补字段时
+    才追加到表头末尾，只报告版本差异而不写入的运行不会改动 results.csv。
+
+    新图片的行直接追加。CSV 中已有行的图片 (重新提取) 的新行先逐张追加到替换文件
+    results.csv.replace.jsonl，close() 时一次性重写 CSV：删掉这些图片的旧行、追加新行，
+    与 SqliteResultWriter 按文件名先删后插的结果一致。中途崩溃时由 ProgressIndex.repair_csv
+    只合并已完成图片的新行 (见 merge_csv_replacements)。
+    """
+
+    def __init__(self, path, expected_fieldnames):
+        self.path = path
+        self.replace_path = path + CSV_REPLACE_SUFFIX
+        self.csvfile = None
+        self.writer = None
+        self.replace_file = None
+        self.existing = set() # CSV 中已有行的文件名，open() 时读取
+        self.missing = [] # schema 新增、CSV 表头中还没有的字段，第一次写入时再追加
+
+        # 检查文件是否存在，如果存在，读取它实际的表头顺序
+        self.fieldnames = expected_fieldnames
+        self.file_exists = os.path.exists(self.path)
+
+        if self.file_exists:
+            try:
+                existing_header = read_csv_header(self.path)
                 if existing_header:
                     # 如果文件有表头，强制使用文件的表头顺序
-                    final_fieldnames = existing_header
+                    self.fieldnames = existing_header
                     print("检测到现有 CSV，将使用现有表头顺序写入。")
-        except Exception as e:
-            print(f"读取现有 CSV 表头失败: {e}，将使用默认顺序。")
+                    self.missing = [f for f in expected_fieldnames if f not in existing_header]
+            except Exception as e:
+                print(f"读取现有 CSV 表头失败: {e}，将使用默认顺序。")
 
-    # 5. 打开 CSV 准备写入
-    # 注意：extrasaction='ignore' 是为了防止 Schema 新增了字段但旧 CSV 没有该列时报错
-    with open(output_csv, mode='a', encoding='utf-8-sig', newline='') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=final_fieldnames, extrasaction='ignore')
-        
-        if not file_exists:
+    def add_columns(self):
+        """把 schema 新增的字段追加到表头末尾并重写 CSV，旧行的新列留空。"""
+        if not self.missing:
+            return
+        reopen = self.csvfile is not None
+        if reopen:
+            self.csvfile.close()
+        temp_path = self.path + ".tmp"
+        with open(self.path, mode='r', encoding='utf-8-sig', newline='') as src, \
+                open(temp_path, mode='w', encoding='utf-8-sig', newline='') as dst:
+            reader = csv.reader(src)
+            writer = csv.writer(dst)
+            next(reader, None)
+            writer.writerow(self.fieldnames + self.missing)
+            for row in reader:
+                writer.writerow(row + [''] * len(self.missing) if row else row)
+        os.replace(temp_path, self.path)
+        self.fieldnames = self.fieldnames + self.missing
+        print(f"CSV 表头新增字段: {', '.join(self.missing)}")
+        self.missing = []
+        if reopen:
+            self.open_append()
+
+    def open_append(self):
+        # 注意：extrasaction='ignore' 是为了忽略行中不属于 CSV 表头的键 (如 schema_version)
+        self.csvfile = open(self.path, mode='a', encoding='utf-8-sig', newline='')
+        self.writer = csv.DictWriter(self.csvfile, fieldnames=self.fieldnames, extrasaction='ignore')
+
+    def open(self):
+        if self.file_exists:
+            with open(self.path, mode='r', encoding='utf-8-sig', newline='') as f:
+                reader = csv.reader(f)
+                next(reader, None)
+                self.existing = {row[0] for row in reader if row}
+        elif os.path.exists(self.replace_path):
+            # CSV 已被删除，上次遗留的替换文件不再有意义
+            os.remove(self.replace_path)
+        self.open_append()
+
+        if not self.file_exists:
+            self.writer.writeheader()
+            self.file_exists = True
+
+    def patch(self, patches, fields, rank_field):
+        """把 {文件名: ItemModel 列表} 中的 fields 写回已有的行并重写 CSV，返回更新的行数。
+
+        有排名字段时按 (文件名, 排名) 对齐，否则按同一文件内的行顺序对齐。
+        """
+        self.add_columns()
+        temp_path = self.path + ".tmp"
+        updated = 0
+        positions = {}
+        with open(self.path, mode='r', encoding='utf-8-sig', newline='') as src, \
+                open(temp_path, mode='w', encoding='utf-8-sig', newline='') as dst:
+            reader = csv.DictReader(src)
+            writer = csv.DictWriter(dst, fieldnames=reader.fieldnames, extrasaction='ignore')
             writer.writeheader()
+            for row in reader:
+                items_list = patches.get(row['filename'])
+                if items_list:
+                    index = positions.get(row['filename'], 0)
+                    positions[row['filename']] = index + 1
+                    if rank_field:
+                        item = next((i for i in items_list if str(getattr(i, rank_field)) == row.get(rank_field)), None)
+                    else:
+                        item = items_list[index] if index < len(items_list) else None
+                    if item is not None:
+                        row.update({f: getattr(item, f) for f in fields})
+                        updated += 1
+                writer.writerow(row)
+        os.replace(temp_path, self.path)
+        return updated
+
+    def write(self, filename, rows):
+        self.add_columns()
+        if filename in self.existing:
+            # 已有行的图片：整张图片的新行作为一行 JSON 追加到替换文件，close() 时统一替换旧行
+            if self.replace_file is None:
+                self.replace_file = open(self.replace_path, mode='w', encoding='utf-8')
+            self.replace_file.write(json.dumps({'filename': filename, 'rows': rows}, ensure_ascii=False, default=str) + "\n")
+            self.replace_file.flush()
+            return
+        # DictWriter 会自动根据 fieldnames 的顺序从 row 字典中取值
+        for row in rows:
+            self.writer.writerow(row)
+        # 每张图片写完立即 flush，中断后可以断点续传
+        self.csvfile.flush()
+
+    def close(self):
+        if self.csvfile:
+            self.csvfile.close()
+            self.csvfile = None
+        if self.replace_file:
+            self.replace_file.close()
+            self.replace_file = None
+            replaced = merge_csv_replacements(self.path)
+            print(f"results.csv 中 {replaced} 张重新提取的图片的旧行已替换。")
+
+class SqliteResultWriter:
+    """类型化的结果写入器：按 ItemModel 生成 results 表，int / float / bool 按原类型存储，缺失值为 NULL。
+
+    schema 新增字段时自动添加列。每张图片的行在一个事务中先删后插，
+    中途崩溃留下的部分行会在重新提取时整体替换。
+    读取见 export.py 的 load_results。
+    """
+
+    BASE_COLUMNS = {'screen_width': "INTEGER", 'screen_height': "INTEGER"} # 其余基础列为 TEXT
+
+    def __init__(self, path, base_fieldnames, schema, csv_path=None):
+        self.path = path
+        self.columns = [(name, self.BASE_COLUMNS.get(name, "TEXT")) for name in base_fieldnames]
+        self.columns += [(name, sqlite_type(field.annotation))
+                         for name, field in schema.ItemModel.model_fields.items() if name not in base_fieldnames]
+        self.columns.append(('schema_version', "TEXT")) # 产生该行的 ItemModel 版本，见 schema_version
+        quoted = ", ".join(f'"{name}"' for name, _ in self.columns)
+        placeholders = ", ".join("?" for _ in self.columns)
+        self.insert_sql = f"INSERT INTO results ({quoted}) VALUES ({placeholders})"
+
+        is_new = not os.path.exists(path)
+        self.conn = sqlite3.connect(path)
+        column_sql = ", ".join(f'"{name}" {sql_type}' for name, sql_type in self.columns)
+        self.conn.execute(f"CREATE TABLE IF NOT EXISTS results ({column_sql})")
+        existing = {row[1] for row in self.conn.execute("PRAGMA table_info(results)")}
+        for name, sql_type in self.columns:
+            if name not in existing:
+                self.conn.execute(f'ALTER TABLE results ADD COLUMN "{name}" {sql_type}')
+        self.conn.execute("CREATE INDEX IF NOT EXISTS results_filename ON results (filename)")
+        self.conn.commit()
+        if is_new and csv_path and os.path.exists(csv_path):
+            self.import_csv(csv_path)
+        self.conn.close()
+        self.conn = None
 
-        for filename in all_files:
-            if filename in processed_files:
+    @staticmethod
+    def convert(value, sql_type):
+        """把 CSV 中的字符串转换为列类型对应的值，空字符串和无法解析的值转为 None。"""
+        if value is None or value == '':
+            return None
+        try:
+            if sql_type == "BOOLEAN":
+                return {'true': 1, 'false': 0, '1': 1, '0': 0}.get(value.strip().lower())
+            if sql_type == "INTEGER":
+                return int(float(value))
+            if sql_type == "REAL":
+                return float(value)
+        except ValueError:
+            return None
+        return value
+
+    def import_csv(self, csv_path):
+        """首次启用 sqlite 后端时，把已有 results.csv 的行按列类型转换后导入 (只做这一次字符串解析)。"""
+        with open(csv_path, mode='r', encoding='utf-8-sig', newline='') as f:
+            rows = [[self.convert(row.get(name), sql_type) for name, sql_type in self.columns]
+                    for row in csv.DictReader(f)]
+        with self.conn:
+            self.conn.executemany(self.insert_sql, rows)
+        print(f"已把 results.csv 中的 {len(rows)} 行导入 {os.path.basename(self.path)}。")
+
+    def open(self):
+        self.conn = sqlite3.connect(self.path)
+
+    def patch(self, patches, fields, rank_field):
+        """按 (文件名, 排名) 或行顺序把 fields 写回已有的行，在一个事务中完成，返回更新的行数。"""
+        conn = self.conn or sqlite3.connect(self.path)
+        assignments = ", ".join(f'"{f}" = ?' for f in fields)
+        updated = 0
+        try:
+            with conn:
+                for filename, items_list in patches.items():
+                    rowids = [row[0] for row in conn.execute(
+                        "SELECT rowid FROM results WHERE filename = ? ORDER BY rowid", (filename,))]
+                    for index, rowid in enumerate(rowids):
+                        if rank_field:
+                            rank = conn.execute(f'SELECT "{rank_field}" FROM results WHERE rowid = ?', (rowid,)).fetchone()[0]
+                            item = next((i for i in items_list if getattr(i, rank_field) == rank), None)
+                        else:
+                            item = items_list[index] if index < len(items_list) else None
+                        if item is not None:
+                            conn.execute(f"UPDATE results SET {assignments} WHERE rowid = ?",
+                                         [getattr(item, f) for f in fields] + [rowid])
+                            updated += 1
+        finally:
+            if conn is not self.conn:
+                conn.close()
+        return updated
+
+    def write(self, filename, rows):
+        with self.conn:
+            self.conn.execute("DELETE FROM results WHERE filename = ?", (filename,))
+            self.conn.executemany(self.insert_sql, [[row.get(name) for name, _ in self.columns] for row in rows])
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
+class DirectoryJob:
+    """单个任务目录的提取上下文：schema、元数据、待处理图片，以及该目录唯一的结果写入器。
+
+    模型调用可以在任意线程中进行，但 write_result 只应由调度它的主线程调用，
+    这样每个目录的 results.csv / results.sqlite 始终只有一个写入者。
+    """
+
+    def __init__(self, directory, schema):
+        self.directory = directory
+        self.name = os.path.basename(directory)
+        self.schema = schema
+        self.is_open = False
+        self.written = set()
+        self.filtered_count = 0
+
+        print(f"\n======== 正在准备任务目录: {self.name} ========")
+        
+        # 路径定义
+        # 优先使用 spider 写出的精简元数据文件，旧目录回退到内嵌截图的 data.json
+        json_data_file = os.path.join(directory, METADATA_FILE_NAME)
+        if not os.path.exists(json_data_file):
+            json_data_file = os.path.join(directory, LEGACY_DATA_FILE_NAME)
+        self.output_csv = os.path.join(directory, "results.csv")
+        self.output_db = os.path.join(directory, RESULTS_DB_NAME)
+        
+        # 2. 加载元数据
+        self.metadata_map = load_metadata_from_json(json_data_file)
+        
+        # 3. 获取图片列表
+        all_files = [f for f in os.listdir(directory) if f.lower().endswith(('.jpg', '.jpeg', '.png'))]
+        all_files.sort()
+        
+        self.base_fieldnames = ['filename', 'time', 'participant_id', 'device_model','android_version', 'screen_width', 'screen_height']
+        schema_fieldnames = list(schema.ItemModel.model_fields.keys())
+
+        # 以 OUTPUT_BACKENDS 中的第一个后端为主输出，删除它即可整体重跑
+        primary_output = self.output_db if OUTPUT_BACKENDS[0] == "sqlite" else self.output_csv
+        self.progress = ProgressIndex(directory, self.output_csv, primary_output)
+        if self.progress.cleared:
+            # 整体重跑：其它后端的旧结果一并清除，否则没有重新提取的图片 (已不在目录中或失败) 会残留旧行，
+            # 而 export.py 优先读取 results.sqlite
+            for path in (self.output_csv, self.output_db):
+                if path != primary_output and os.path.exists(path):
+                    os.remove(path)
+                    print(f"主输出已删除，同时清除旧的 {os.path.basename(path)}。")
+        self.schema_version = schema_version(schema)
+        self.patch_tasks = {} # 缺少的字段元组 -> 需要补提取这些字段的图片
+        self.progress.register_version(self.schema_version, schema_fieldnames)
+        self.check_schema_version(schema_fieldnames)
+        self.pending = self.progress.sync(all_files)
+        print(f"发现 {len(all_files)} 张图片，已处理 {len(all_files) - len(self.pending)} 张。")
+        # 近似重复分组：代表图片 -> 直接复用其结果的组员
+        self.duplicates = {}
+        self.verify_pairs = {}
+        self.verify_results = {}
+        self.verify_stats = {'checked': 0, 'mismatched': 0}
+        if getattr(schema, "NEAR_DUPLICATES", NEAR_DUPLICATES):
+            self.group_near_duplicates()
+        self.remaining = len(self.pending)
+
+        # 4. 确定输出字段并创建各后端的写入器
+        expected_fieldnames = self.base_fieldnames + schema_fieldnames
+        self.writers = []
+        if "csv" in OUTPUT_BACKENDS:
+            self.writers.append(CsvResultWriter(self.output_csv, expected_fieldnames))
+        if "sqlite" in OUTPUT_BACKENDS:
+            self.writers.append(SqliteResultWriter(self.output_db, self.base_fieldnames, schema, self.output_csv))
+
+    def check_schema_version(self, schema_fieldnames):
+        """找出由缺少当前 ItemModel 某些字段的旧版本提取的图片，按 SCHEMA_MIGRATION 报告或重新提取。"""
+        header = read_csv_header(self.output_csv)
+        if header:
+            self.progress.assign_legacy_version([f for f in header if f not in self.base_fieldnames])
+        stale = self.progress.stale_images(schema_fieldnames)
+        if not stale:
+            return
+        missing_counts = {}
+        for missing in stale.values():
+            missing_counts[missing] = missing_counts.get(missing, 0) + 1
+        for missing, count in sorted(missing_counts.items()):
+            print(f"schema 已更新: {count} 张图片的结果缺少字段 {', '.join(missing)}")
+
+        migration = getattr(self.schema, "SCHEMA_MIGRATION", SCHEMA_MIGRATION)
+        if migration == "reextract":
+            # 旧行保留，新结果写入时各后端按文件名整体替换；提取失败或图片已不在目录中时旧行不受影响
+            self.progress.reset(stale)
+            print(f"将只重新提取这 {len(stale)} 张图片。")
+        elif migration == "fields":
+            for filename, missing in stale.items():
+                self.patch_tasks.setdefault(missing, []).append(filename)
+            print(f"将只为这 {len(stale)} 张图片提取缺少的字段。")
+        else:
+            print('设置 SCHEMA_MIGRATION = "reextract" 或 "fields" 可只重新提取这些图片或字段。')
+
+    def group_near_duplicates(self):
+        """按 dHash 把待处理图片中的近似重复分组，组员从 pending 中移出，等组代表写入时复用其结果。
+
+        每张图片与已有的组代表比较，汉明距离不超过阈值即加入该组，否则自成一组。
+        只在同一参与者内分组时，元数据中没有 participant_id 的图片无法确认来源，不参与分组。
+        FORCE_EXTRACT 中的文件始终单独提取；按 NEAR_DUPLICATE_VERIFY_RATE 抽中的组员也单独提取，
+        写入时与组代表的结果比较，用来检验阈值是否过宽。
+        """
+        if Image is None:
+            print("未安装 Pillow，跳过近似重复检测。")
+            return
+        threshold = getattr(self.schema, "DHASH_THRESHOLD", DHASH_THRESHOLD)
+        verify_rate = getattr(self.schema, "NEAR_DUPLICATE_VERIFY_RATE", NEAR_DUPLICATE_VERIFY_RATE)
+        forced = set(getattr(self.schema, "FORCE_EXTRACT", FORCE_EXTRACT))
+
+        representatives = {} # 分组范围 (参与者) -> [(代表文件名, 哈希), ...]
+        copied = set()
+        for filename in self.pending:
+            if filename in forced:
                 continue
-            
-            file_path = os.path.join(directory, filename)
-            print(f"  -> 处理: {filename} ... ", end="", flush=True)
+            scope = self.metadata_map.get(filename, {}).get('participant_id') if NEAR_DUPLICATE_SAME_PARTICIPANT else None
+            if NEAR_DUPLICATE_SAME_PARTICIPANT and scope is None:
+                # 不同参与者看到的价格可能不同，来源不明的图片单独提取
+                continue
+            try:
+                value = dhash(os.path.join(self.directory, filename))
+            except Exception as e:
+                print(f"  -> 无法计算感知哈希: {filename}: {e}")
+                continue
+            candidates = representatives.setdefault(scope, [])
+            match = next((rep for rep, rep_hash in candidates if hamming_distance(value, rep_hash) <= threshold), None)
+            if match is None:
+                candidates.append((filename, value))
+            elif random.random() < verify_rate:
+                self.verify_pairs[filename] = match
+            else:
+                self.duplicates.setdefault(match, []).append(filename)
+                copied.add(filename)
+
+        if copied:
+            self.pending = [f for f in self.pending if f not in copied]
+            print(f"近似重复: {len(copied)} 张图片将复用 {len(self.duplicates)} 张代表图片的结果"
+                  f"，抽检 {len(self.verify_pairs)} 张。")
+
+    def check_duplicate(self, filename, items_list):
+        """记录抽检组员及其代表的结果；两者都写入后比较是否一致。"""
+        pairs = [(member, rep) for member, rep in self.verify_pairs.items() if filename in (member, rep)]
+        if not pairs:
+            return
+        self.verify_results[filename] = [item.model_dump() for item in items_list or [] if item is not None]
+        for member, rep in pairs:
+            if member in self.verify_results and rep in self.verify_results:
+                self.verify_stats['checked'] += 1
+                if self.verify_results[member] != self.verify_results[rep]:
+                    self.verify_stats['mismatched'] += 1
+                    print(f"  -> [{self.name}] 近似重复抽检不一致: {member} 与 {rep}")
+
+    def report_duplicates(self):
+        if self.verify_stats['checked']:
+            print(f"[{self.name}] 近似重复抽检: {self.verify_stats['checked']} 组，"
+                  f"不一致 {self.verify_stats['mismatched']} 组")
 
-            # 准备基础数据
-            meta = metadata_map.get(filename, {})
-            base_row = {k: meta.get(k) for k in base_fieldnames if k != 'filename'}
-            base_row['filename'] = filename
+    def open(self):
+        # 5. 打开各写入器准备写入
+        for writer in self.writers:
+            writer.open()
+        self.progress.set_dirty(True)
+        self.is_open = True
 
+    def close(self):
+        if self.is_open:
+            for writer in self.writers:
+                writer.close()
+            self.is_open = False
+            self.progress.set_dirty(False)
+
+    def base_row(self, filename):
+        # 准备基础数据
+        meta = self.metadata_map.get(filename, {})
+        base_row = {k: meta.get(k) for k in self.base_fieldnames if k != 'filename'}
+        base_row['filename'] = filename
+        return base_row
+
+    def filter_items(self, items_list):
+        """按 schema.py 中的 ITEM_FILTERS (谓词，返回 False 的条目被丢弃) 过滤条目。
+
+        过滤器出错时打印警告并保留原条目。有条目被过滤掉时，按原排名顺序把剩余条目的
+        排名字段重新编号为 1..n，保证排名连续。补提取字段 (run_patch) 的条目也经过这一步，
+        排名才能与已写入的行对上。
+        """
+        filters = getattr(self.schema, "ITEM_FILTERS", [])
+        if not items_list or not filters:
+            return items_list
+        result = []
+        for item in items_list:
             try:
-                base64_img = encode_image(file_path)
-
-                # === 核心调用 ===
-                response = client.beta.chat.completions.parse(
-                    model=MODEL_NAME,
-                    messages=[
-                        {"role": "system", "content": schema.SYSTEM_PROMPT},
-                        {
-                            "role": "user", 
-                            "content": [
-                                {"type": "text", "text": schema.USER_PROMPT_TEXT},
-                                {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_img}"}}
-                            ]
-                        },
-                    ],
-                    response_format=schema.ResponseModel,
-                )
-                
-                parsed_result = response.choices[0].message.parsed
-                items_list = getattr(parsed_result, schema.LIST_FIELD_NAME, [])
-                if getattr(schema, "SINGLE_ITEM",False):
-                    items_list=[items_list]
-                
-                item_count = 0
-                if items_list:
-                    for item in items_list:
-                        row = base_row.copy()
-                        # 将 Pydantic 对象转为 dict 并更新到 row
-                        row.update(item.model_dump())
-                        
-                        # DictWriter 会自动根据 fieldnames 的顺序从 row 字典中取值
-                        # 如果 row 中有一些字段在 final_fieldnames 中不存在 (比如 Schema 新增了字段)，
-                        # extrasaction='ignore' 会忽略它们，防止崩溃。
-                        writer.writerow(row)
-                        item_count += 1
-                else:
-                    writer.writerow(base_row)
-
-                csvfile.flush()
-                print(f"提取 {item_count} 条")
+                if item is not None and not all(keep(item) for keep in filters):
+                    continue
+            except Exception as e:
+                print(f"  -> [{self.name}] schema 钩子出错，保留原条目: {e}")
+            result.append(item)
+        rank_field = rank_field_of(self.schema)
+        if len(result) < len(items_list) and rank_field:
+            ranked = sorted((item for item in result if item is not None),
+                            key=lambda item: (getattr(item, rank_field) is None, getattr(item, rank_field) or 0))
+            result = [item.model_copy(update={rank_field: rank}) for rank, item in enumerate(ranked, start=1)]
+        return result
+
+    def apply_hooks(self, items_list):
+        """先按 ITEM_FILTERS 过滤条目并重新编号排名 (见 filter_items)，再依次用 ITEM_TRANSFORMS
+        (返回替换后的 ItemModel) 处理剩余条目，写入前调用。
+
+        钩子出错时打印警告并保留原条目，不影响其它图片的写入。
+        """
+        transforms = getattr(self.schema, "ITEM_TRANSFORMS", [])
+        kept = self.filter_items(items_list)
+        if items_list:
+            self.filtered_count += len(items_list) - len(kept)
+        if not kept or not transforms:
+            return kept
+        result = []
+        for item in kept:
+            try:
+                transformed = item
+                for transform in transforms:
+                    transformed = transform(transformed)
+            except Exception as e:
+                print(f"  -> [{self.name}] schema 钩子出错，保留原条目: {e}")
+                transformed = item
+            result.append(transformed)
+        return result
+
+    def write_result(self, filename, items_list, latency=None, tokens=None):
+        """写入一张图片的提取结果并在进度索引中标记完成，返回写入的条目数。
+
+        条目先经过 schema.py 中声明的过滤和转换钩子 (见 apply_hooks)。
+        """
+        kept_items = self.apply_hooks(items_list)
+        base_row = self.base_row(filename)
+        rows = []
+        for item in kept_items or []:
+            row = base_row.copy()
+            # 将 Pydantic 对象转为 dict 并更新到 row
+            row.update(item.model_dump())
+            row['schema_version'] = self.schema_version
+            rows.append(row)
+        item_count = len(rows)
+        if not rows:
+            rows.append(dict(base_row, schema_version=self.schema_version))
+
+        # 所有后端都写完后再在进度索引中标记完成，中断后可以断点续传
+        for writer in self.writers:
+            writer.write(filename, rows)
+        self.progress.finish(filename, item_count, latency, tokens, self.schema_version)
+        self.written.add(filename)
+
+        self.check_duplicate(filename, items_list)
+        for member in self.duplicates.pop(filename, []):
+            self.write_result(member, items_list)
+            print(f"  -> [{self.name}] 近似重复: {member} 复用 {filename} 的结果")
+        return item_count
+
+
+def extract_task(job, filenames):
+    """工作线程中执行的单个任务：在进度索引中标记 in-flight，提取后返回 (结果, 每张耗时, 每张 token)。"""
+    job.progress.start(filenames)
+    call_usage.tokens = 0
+    started_at = time.monotonic()
+    results = extract_group(job.schema, job.directory, filenames, job.metadata_map)
+    latency = (time.monotonic() - started_at) / len(filenames)
+    return results, latency, call_usage.tokens / len(filenames)
+
+def prepare_directory(directory):
+    """加载目录的 schema 并收集待处理图片；没有 schema.py 的目录返回 None。"""
+    # 1. 动态加载该目录的配置 (Schema)
+    schema = load_schema_module(directory)
+    if not schema:
+        return None
+    return DirectoryJob(directory, schema)
+
+def run_extraction(jobs, max_workers=MAX_WORKERS):
+    """把所有目录的待处理图片放入同一个按优先级排序的队列，由共享的线程池消费。
+
+    待处理图片少的目录排在前面，小目录可以尽早完成，不必等大目录跑完；
+    总吞吐量只受 max_workers 限制。schema 设置了 IMAGES_PER_REQUEST 时，
+    同一目录的图片按该数量打包成一个请求。模型调用在工作线程中进行，
+    结果回到主线程，由对应目录的 DirectoryJob 写入各自的 CSV。
+    """
+    open_cache()
+    jobs = [job for job in jobs if job.pending]
+    if not jobs:
+        print("\n没有待处理的图片。")
+        return
+
+    # 优先级：(目录待处理数, 目录名, 文件名)；打包的请求以组内第一个文件名排序
+    queue = []
+    for job in jobs:
+        size = images_per_request(job.schema)
+        for start in range(0, len(job.pending), size):
+            queue.append((len(job.pending), job.name, job.pending[start:start + size], job))
+    queue.sort(key=lambda task: (task[0], task[1], task[2][0]))
+    image_count = sum(len(job.pending) for job in jobs)
+    print(f"\n======== 共 {len(jobs)} 个目录、{image_count} 张图片 ({len(queue)} 个请求) 待处理，并发上限 {max_workers} ========")
+
+    for job in jobs:
+        job.open()
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            futures = {
+                executor.submit(extract_task, job, filenames): (job, filenames)
+                for _, _, filenames, job in queue
+            }
+            for future in as_completed(futures):
+                job, filenames = futures[future]
+                job.remaining -= len(filenames)
+
+                latency = tokens = None
+                try:
+                    results, latency, tokens = future.result()
+                except Exception as e:
+                    results = {filename: e for filename in filenames}
+                for filename in filenames:
+                    items_list = results.get(filename)
+                    if isinstance(items_list, Exception):
+                        job.progress.fail(filename, items_list)
+                        print(f"  -> [{job.name}] 处理: {filename} ... 出错: {items_list}")
+                        continue
+                    item_count = job.write_result(filename, items_list or [], latency, tokens)
+                    print(f"  -> [{job.name}] 处理: {filename} ... 提取 {item_count} 条")
+
+                if job.remaining == 0:
+                    job.close()
+                    job.report_duplicates()
+                    filtered = f"，schema 过滤 {job.filtered_count} 条" if job.filtered_count else ""
+                    print(f"======== 任务目录 {job.name} 处理完毕: {job.progress.report()}{filtered} ========")
+    finally:
+        for job in jobs:
+            job.close()
+
+def run_patch(job, fields, filenames=None, max_workers=MAX_WORKERS):
+    """只重新提取 fields 这几个字段，并按文件名和排名写回已有的结果行。
 
+    使用精简的 ResponseModel 和 SYSTEM_PROMPT (见 PatchSchema)，输出 token 和延迟随字段数减少。
+    filenames 为 None 时处理目录中所有已完成的图片。所有图片提取完后一次性写回各后端；
+    中途中断时已提取的部分保存在缓存中，重跑不会重复调用模型。
+    """
+    open_cache()
+    patch_schema = PatchSchema(job.schema, fields)
+    filenames = sorted(filenames if filenames is not None else job.progress.done_images())
+    if not filenames:
+        return
+    size = images_per_request(job.schema)
+    groups = [filenames[start:start + size] for start in range(0, len(filenames), size)]
+    print(f"\n======== [{job.name}] 为 {len(filenames)} 张图片重新提取字段: {', '.join(fields)} ========")
+
+    patches = {}
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = {executor.submit(extract_group, patch_schema, job.directory, group, job.metadata_map): group
+                   for group in groups}
+        for future in as_completed(futures):
+            try:
+                results = future.result()
             except Exception as e:
-                print(f"出错: {e}")
-                time.sleep(1)
+                results = {filename: e for filename in futures[future]}
+            for filename, items_list in results.items():
+                if isinstance(items_list, Exception):
+                    print(f"  -> [{job.name}] 字段提取: {filename} ... 出错: {items_list}")
+                    continue
+                # 与写入时一样过滤并重新编号排名，再按排名匹配已有的行
+                patches[filename] = [item for item in job.filter_items(items_list) if item is not None]
+                print(f"  -> [{job.name}] 字段提取: {filename} ... {len(patches[filename])} 条")
+
+    rank_field = rank_field_of(job.schema)
+    for writer in job.writers:
+        updated = writer.patch(patches, fields, rank_field)
+        print(f"[{job.name}] {type(writer).__name__} 更新 {updated} 行")
+    # 补齐了缺少字段的图片记为当前 schema 版本
+    stale = job.progress.stale_images(list(job.schema.ItemModel.model_fields))
+    job.progress.set_version([f for f in patches if set(stale.get(f, ())) <= set(fields)], job.schema_version)
+
+# ================= Batch API =================
+
+def batch_state_path():
+    return os.path.join(BATCH_DIR, "state.json")
+
+def load_batch_state():
+    """已提交但尚未收取结果的批次 id 列表。"""
+    if not os.path.exists(batch_state_path()):
+        return []
+    with open(batch_state_path(), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def save_batch_state(batch_ids):
+    os.makedirs(BATCH_DIR, exist_ok=True)
+    with open(batch_state_path() + '.part', 'w', encoding='utf-8') as f:
+        json.dump(batch_ids, f)
+    os.replace(batch_state_path() + '.part', batch_state_path())
+
+def write_batch_files(jobs):
+    """把所有待处理图片写成 JSONL 请求文件，超过单文件上限时自动分片，返回文件路径列表。
+
+    每行的 custom_id 为 "目录名/文件名|缓存键"，body 与实时调用使用相同的 prompt 和
+    ResponseModel 生成的 JSON schema。缓存命中的图片直接写回，不进入批次。
+    批量模式不做长截图分块，始终按整图提交。
+    """
+    os.makedirs(BATCH_DIR, exist_ok=True)
+    stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    paths = []
+    f = None
+    size = count = 0
+    try:
+        for job in jobs:
+            response_format = type_to_response_format_param(job.schema.ResponseModel)
+            for filename in job.pending:
+                if filename in job.written:
+                    continue
+                base64_img, image_hash = read_image(os.path.join(job.directory, filename), job.schema)
+                cache_key = ExtractionCache.make_key(job.schema, image_hash)
+                items_list = cached_items(job.schema, cache_key)
+                if items_list is not None:
+                    # 缓存命中的图片直接写回 CSV，不进入批次
+                    item_count = job.write_result(filename, items_list)
+                    print(f"  -> [{job.name}] 缓存命中: {filename} ... 提取 {item_count} 条")
+                    continue
+                body = {
+                    "model": MODEL_NAME,
+                    "messages": build_messages(job.schema, base64_img),
+                    "response_format": response_format,
+                }
+                line = json.dumps({
+                    "custom_id": f"{job.name}/{filename}|{cache_key}",
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": body,
+                }, ensure_ascii=False).encode('utf-8') + b"\n"
+
+                if f is None or size + len(line) > BATCH_MAX_BYTES or count >= BATCH_MAX_REQUESTS:
+                    if f:
+                        f.close()
+                    paths.append(os.path.join(BATCH_DIR, f"requests_{stamp}_{len(paths)}.jsonl"))
+                    f = open(paths[-1], 'wb')
+                    size = count = 0
+                f.write(line)
+                size += len(line)
+                count += 1
+    finally:
+        if f:
+            f.close()
+    return paths
+
+def submit_batch_file(path):
+    """上传请求文件并创建批次，返回批次 id。"""
+    with open(path, 'rb') as f:
+        input_file = client.files.create(file=f, purpose="batch")
+    batch = client.batches.create(
+        input_file_id=input_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+    print(f"已提交批次 {batch.id} ({os.path.basename(path)})")
+    return batch.id
+
+def wait_for_batch(batch_id, poll_interval=BATCH_POLL_INTERVAL):
+    """轮询直到批次结束 (完成、失败、过期或取消)，返回最终的批次对象。"""
+    while True:
+        batch = client.batches.retrieve(batch_id)
+        if batch.status in ("completed", "failed", "expired", "cancelled"):
+            return batch
+        counts = batch.request_counts
+        progress = f"{counts.completed}/{counts.total}" if counts else "-"
+        print(f"批次 {batch_id} 状态: {batch.status}，进度 {progress}，{poll_interval}s 后再次查询...")
+        time.sleep(poll_interval)
+
+def collect_batch_results(batch, jobs_by_name):
+    """下载批次输出，逐行用各目录的 ResponseModel 校验后写回对应的 CSV。
+
+    失败或无法解析的请求只打印错误，图片保持未处理状态，下次运行会重新提交。
+    """
+    print(f"批次 {batch.id} 结束，状态: {batch.status}")
+    if not batch.output_file_id:
+        return
+    output = client.files.content(batch.output_file_id).text
+    for line in output.splitlines():
+        if not line.strip():
+            continue
+        result = json.loads(line)
+        custom_id, _, cache_key = result["custom_id"].partition("|")
+        dir_name, filename = custom_id.split("/", 1)
+        job = jobs_by_name.get(dir_name)
+        if job is None or filename in job.written:
+            continue
+        try:
+            response = result.get("response") or {}
+            if result.get("error") or response.get("status_code") != 200:
+                raise RuntimeError(result.get("error") or response.get("status_code"))
+            content = response["body"]["choices"][0]["message"]["content"]
+            parsed_result = job.schema.ResponseModel.model_validate_json(content)
+            if cache is not None and cache_key:
+                cache.put(cache_key, parsed_result.model_dump_json())
+            item_count = job.write_result(filename, items_from_parsed(job.schema, parsed_result))
+            print(f"  -> [{job.name}] 处理: {filename} ... 提取 {item_count} 条")
+        except Exception as e:
+            job.progress.fail(filename, e)
+            print(f"  -> [{job.name}] 处理: {filename} ... 出错: {e}")
+
+def run_batch(jobs, poll_interval=BATCH_POLL_INTERVAL):
+    """Batch API 模式：先收取上次未收取的批次，再为剩余图片生成请求文件、提交并等待完成。
+
+    已提交的批次 id 记录在 .batches/state.json 中，脚本中断后重新运行会继续等待这些批次，
+    不会重复提交。
+    """
+    open_cache()
+    jobs_by_name = {job.name: job for job in jobs}
+    for job in jobs:
+        job.open()
+    try:
+        batch_ids = load_batch_state()
+        if batch_ids:
+            print(f"\n======== 继续收取 {len(batch_ids)} 个已提交的批次 ========")
+        for batch_id in list(batch_ids):
+            collect_batch_results(wait_for_batch(batch_id, poll_interval), jobs_by_name)
+            batch_ids.remove(batch_id)
+            save_batch_state(batch_ids)
+
+        pending_count = sum(1 for job in jobs for f in job.pending if f not in job.written)
+        if not pending_count:
+            print("\n没有待处理的图片。")
+            return
+        print(f"\n======== 正在为 {pending_count} 张图片生成批量请求文件 ========")
+        for path in write_batch_files(jobs):
+            batch_ids.append(submit_batch_file(path))
+            save_batch_state(batch_ids)
+            # 请求文件已上传，本地副本 (内嵌全部图片 Base64) 不再需要
+            os.remove(path)
+
+        for batch_id in list(batch_ids):
+            collect_batch_results(wait_for_batch(batch_id, poll_interval), jobs_by_name)
+            batch_ids.remove(batch_id)
+            save_batch_state(batch_ids)
+    finally:
+        for job in jobs:
+            job.close()
+            job.report_duplicates()
+
+def process_directory(directory, max_workers=MAX_WORKERS):
+    """处理单个子目录的核心逻辑"""
+    job = prepare_directory(directory)
+    if job:
+        run_extraction([job], max_workers)
 
 def main():
     root_dir = os.path.dirname(os.path.abspath(__file__))
     
-    # 遍历当前目录下的所有子文件夹
-    for entry in os.listdir(root_dir):
+    # 收集当前目录下所有子文件夹的待处理图片，统一调度
+    jobs = []
+    for entry in sorted(os.listdir(root_dir)):
         full_path = os.path.join(root_dir, entry)
         if os.path.isdir(full_path) and not entry.startswith('.'):
-            process_directory(full_path)
+            if PATCH_FIELDS and entry not in PATCH_FIELDS:
+                continue
+            job = prepare_directory(full_path)
+            if job:
+                jobs.append(job)
+
+    if PATCH_FIELDS:
+        # 只重新提取指定字段，不处理新图片
+        for job in jobs:
+            run_patch(job, PATCH_FIELDS[job.name])
+    elif USE_BATCH_API:
+        run_batch(jobs)
+    else:
+        run_extraction(jobs)
+
+    # SCHEMA_MIGRATION = "fields"：为旧版本的图片补提取缺少的字段
+    if not PATCH_FIELDS:
+        for job in jobs:
+            for missing, filenames in job.patch_tasks.items():
+                run_patch(job, list(missing), filenames)
+
+    if cache is not None:
+        cache.report()
+    if not USE_BATCH_API:
+        limiter.report()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -3,6 +3,14 @@ import requests
 import json
 import os
 import base64
+import random
+import email.utils
+import gzip
+import hashlib
+import shutil
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # 加载 .env 文件中的环境变量
 load_dotenv()
@@ -10,8 +18,28 @@ load_dotenv()
 # ================= 配置部分 =================
 LOGIN_URL = 'https://preserve-3.inrialpes.fr/api/sessions'
 DATA_URL = 'https://preserve-3.inrialpes.fr/api/results'
-OUTPUT_FILE_NAME = 'data.json' # 完整的聚合数据文件名
+OUTPUT_FILE_NAME = 'metadata.json' # 精简的聚合元数据文件名 (不含截图 Base64)
+LEGACY_OUTPUT_FILE_NAME = 'data.json' # 旧版内嵌截图 Base64 的聚合数据文件名
+KEEP_RAW_SCREENSHOTS = False # 是否额外保留原始 Base64 截图到压缩的 sidecar 文件
+SCREENSHOT_SIDECAR_NAME = 'screenshots.jsonl.gz' # sidecar 文件名，每行一条 {id, timestamp, screenshot}
+INCREMENTAL_CRAWL = True # 增量爬取：只请求比上次记录的最新结果更新的数据
+CRAWL_STATE_FILE_NAME = 'crawl_state.json' # 每个 job 目录下记录已爬取的最新 timestamp/id
+CHECKPOINT_DIR_NAME = '.pages' # 每个 job 目录下保存分页断点的子目录，全部分页到齐合并后删除
 IMAGE_DIR_BASE = '.' # 图片和JSON保存的根目录，即脚本运行目录
+PAGE_CONCURRENCY = 8 # 单个 job 内同时请求的分页数上限
+MAX_IN_FLIGHT_REQUESTS = 16 # 所有 job 合计同时在途的请求数上限
+REQUEST_TIMEOUT = (10, 60) # (连接超时, 读取超时)，单位秒
+MAX_RETRIES = 5 # 单个请求失败后的最大重试次数
+BACKOFF_BASE = 1.0 # 指数退避的基础等待时间 (秒)
+BACKOFF_MAX = 60.0 # 单次退避等待的上限 (秒)
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504) # 视为暂时性错误、需要重试的状态码
+RATE_LIMIT_PER_SECOND = 8.0 # 全局令牌桶的初始速率 (请求/秒)
+RATE_LIMIT_MIN = 0.5 # 被限流后速率下调的下限
+RATE_LIMIT_MAX = 32.0 # 连续成功后速率上调的上限
+SCREENSHOT_WORKERS = 4 # 每个 job 用于解码和写入截图的线程数
+USE_IMAGE_STORE = True # 截图按内容哈希只存一份，job 目录中的 JPG 为指向它的硬链接
+IMAGE_STORE_DIR_NAME = '.images' # 内容寻址存储目录 (位于 IMAGE_DIR_BASE 下)
+IMAGE_MANIFEST_NAME = 'images.json' # 每个 job 目录下的 {文件名: sha256} 清单
 
 # 新增：需要处理的 job_id 列表
 JOB_IDS_TO_PROCESS = [
@@ -27,6 +55,9 @@ JOB_IDS_TO_PROCESS = [
     "580","581","582","583","584","585","588",
     ]
 
+# 同时处理的 job 数量；默认全部同时开始，总压力由 MAX_IN_FLIGHT_REQUESTS 控制
+JOB_CONCURRENCY = len(JOB_IDS_TO_PROCESS)
+
 
 # 登录账户信息
 LOGIN_PAYLOAD = {
@@ -46,6 +77,302 @@ HEADERS = {
     'Referer': 'https://preserve-3.inrialpes.fr/users/login' 
 }
 
+class TokenBucket:
+    """全局令牌桶限速器，所有线程共享。
+
+    每次请求前取一个令牌；被服务器限流 (429) 时速率减半，并按 Retry-After
+    让所有线程一起暂停；请求成功时速率缓慢回升，从而逼近服务器允许的最高吞吐。
+    """
+
+    def __init__(self, rate=RATE_LIMIT_PER_SECOND, capacity=None,
+                 min_rate=RATE_LIMIT_MIN, max_rate=RATE_LIMIT_MAX):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                else:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                    self.updated_at = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def on_success(self):
+        with self.lock:
+            # 加性增：每成功一次，速率增加约 1/rate，大约每秒 +1 请求/秒
+            self.rate = min(self.max_rate, self.rate + 1.0 / self.rate)
+
+    def on_throttle(self, retry_after=None):
+        with self.lock:
+            # 乘性减，并清空已积累的令牌
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = 0
+            if retry_after:
+                self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+
+
+def parse_retry_after(value):
+    """解析 Retry-After 头，支持秒数和 HTTP 日期两种格式，返回等待秒数。"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+        return max(0.0, retry_at.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class AuthManager:
+    """所有 job 共享的登录凭证。
+
+    Transport 收到 401 时调用 refresh()：多个线程同时发现 token 过期时，
+    只有第一个线程真正重新登录，其余线程等待并直接使用新 token。
+    用 generation 计数区分“我看到的 token 是否已经被别人刷新过”。
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self.token = None
+        self.generation = 0
+        self.state = (None, 0) # (token, generation) 整体替换，读取时不需要加锁
+        self.lock = threading.Lock()
+
+    def login(self):
+        """登录并保存 token，返回是否成功。"""
+        with self.lock:
+            return self._login()
+
+    def _login(self):
+        token = login(self.session)
+        if not token:
+            return False
+        self.token = token
+        self.generation += 1
+        self.state = (token, self.generation)
+        return True
+
+    def current(self):
+        """返回 (token, generation)，generation 用于之后的 refresh()。
+
+        不加锁：Transport 在占用在途名额时调用，若在这里等待正在重新登录的线程，
+        而登录请求又在等待名额，就会互相卡死。刷新期间读到旧 token 的请求
+        会收到 401，随后在 refresh() 中等到新 token。
+        """
+        return self.state
+
+    def refresh(self, stale_generation):
+        """token 已失效时重新登录；若其它线程已经刷新过则直接返回。返回是否有可用的新 token。"""
+        with self.lock:
+            if self.generation != stale_generation:
+                return True
+            print("   Token 已失效，正在重新登录...", flush=True)
+            return self._login()
+
+
+class Transport:
+    """spider 的 HTTP 传输层，包装 requests.Session，接口与 Session.get/put 相同。
+
+    - 每个请求带连接/读取超时，避免单个请求一直挂起；
+    - 连接错误、超时和 RETRY_STATUS_CODES 中的状态码会以指数退避 + 抖动重试，
+      服务器给出 Retry-After 时按它等待；
+    - 通过信号量限制全局在途请求数，通过令牌桶限制全局请求速率；
+    - 设置了 auth 时，带 Authorization 头的请求总是使用 auth 中最新的 token，
+      遇到 401 会重新登录 (同一 token 只登录一次) 并重放该请求。
+    """
+
+    def __init__(self, session, max_in_flight=MAX_IN_FLIGHT_REQUESTS, bucket=None,
+                 timeout=REQUEST_TIMEOUT, max_retries=MAX_RETRIES,
+                 backoff_base=BACKOFF_BASE, backoff_max=BACKOFF_MAX, auth=None):
+        self.session = session
+        self.auth = auth
+        self.slots = threading.BoundedSemaphore(max_in_flight)
+        self.bucket = bucket or TokenBucket()
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.stats_lock = threading.Lock()
+        self.stats = {'requests': 0, 'retries': 0, 'throttled': 0, 'failed': 0, 'reauth': 0}
+
+    def _count(self, key):
+        with self.stats_lock:
+            self.stats[key] += 1
+
+    def backoff_delay(self, attempt):
+        """第 attempt 次重试前的等待时间：指数增长，带全抖动 (full jitter)。"""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        # 只有带 Authorization 头的请求 (即数据请求) 由 auth 管理，登录请求本身不参与
+        use_auth = self.auth is not None and 'Authorization' in (kwargs.get('headers') or {})
+        reauth_count = 0
+        attempt = 0
+        while True:
+            generation = None
+            self.bucket.acquire()
+            retry_after = None
+            try:
+                with self.slots:
+                    # 拿到在途名额后再读取 token，排队期间其它线程刷新过的 token 也能用上
+                    if use_auth:
+                        token, generation = self.auth.current()
+                        kwargs['headers'] = dict(kwargs['headers'], Authorization=f"Bearer {token}")
+                    self._count('requests')
+                    response = self.session.request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if attempt == self.max_retries:
+                    self._count('failed')
+                    raise
+                error = e
+            else:
+                if response.status_code == 401 and use_auth and reauth_count < self.max_retries:
+                    # token 过期：重新登录 (并发线程之间按 generation 去重) 后重放，不计入重试次数。
+                    # 别的线程重新登录期间发出的请求拿到的仍是旧 token，所以同一请求可能
+                    # 需要多次重放，但最多 max_retries 次
+                    reauth_count += 1
+                    self._count('reauth')
+                    if self.auth.refresh(generation):
+                        continue
+                    return response
+                if response.status_code not in RETRY_STATUS_CODES:
+                    self.bucket.on_success()
+                    return response
+                retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                if response.status_code == 429:
+                    self._count('throttled')
+                    self.bucket.on_throttle(retry_after)
+                if attempt == self.max_retries:
+                    # 重试用尽，把最后的响应交给调用方的 raise_for_status 处理
+                    self._count('failed')
+                    return response
+                error = f"HTTP {response.status_code}"
+
+            delay = retry_after if retry_after is not None else self.backoff_delay(attempt)
+            delay = min(delay, self.backoff_max)
+            self._count('retries')
+            print(f"   {method} {url} 失败 ({error})，{delay:.1f}s 后重试 "
+                  f"({attempt + 1}/{self.max_retries})...", flush=True)
+            time.sleep(delay)
+            attempt += 1
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+
+def store_image(image_bytes, digest):
+    """把图片写入内容寻址存储 {IMAGE_DIR_BASE}/.images/ab/abcd....jpg，已存在则跳过写入。"""
+    store_path = os.path.join(IMAGE_DIR_BASE, IMAGE_STORE_DIR_NAME, digest[:2], f"{digest}.jpg")
+    if not os.path.exists(store_path):
+        os.makedirs(os.path.dirname(store_path), exist_ok=True)
+        tmp_path = f"{store_path}.{threading.get_ident()}.part"
+        with open(tmp_path, 'wb') as f:
+            f.write(image_bytes)
+        os.replace(tmp_path, store_path)
+    return store_path
+
+
+def linked_to_store(file_path, store_path):
+    """job 目录中的文件是否已经是指向存储文件的硬链接 (同一个 inode)。
+
+    内容相同但 inode 不同的文件 (以前爬取或由 data.json 迁移写出的 JPG) 返回 False，
+    由调用方替换为硬链接，否则同一张图片会在磁盘上保存两份。
+    """
+    return os.path.exists(file_path) and os.path.samefile(file_path, store_path)
+
+
+def link_image(store_path, file_path):
+    """在 job 目录中创建指向存储文件的硬链接；文件系统不支持硬链接时退回复制。"""
+    tmp_path = f"{file_path}.{threading.get_ident()}.part"
+    try:
+        os.link(store_path, tmp_path)
+    except OSError:
+        shutil.copyfile(store_path, tmp_path)
+    os.replace(tmp_path, file_path)
+
+
+def save_screenshot(item, base_dir):
+    """
+    解码单条记录中 Base64 编码的截图，并保存为 JPG 文件。
+    保存路径格式：{base_dir}/{timestamp}_{id}.jpg
+
+    启用 USE_IMAGE_STORE 时，图片字节按 sha256 只在 .images/ 中保存一份，
+    job 目录中的文件是指向它的硬链接；已经存在的相同图片不会重复写入。
+
+    返回图片的 sha256，失败时返回 None。
+    """
+    # 确保关键字段存在
+    screenshot_b64 = item.get('screenshot')
+    job_id = item.get('job_id')
+    timestamp = item.get('timestamp')
+    _id = item.get('id')
+
+    if not (screenshot_b64 and job_id is not None and timestamp is not None and _id is not None):
+        return None
+
+    try:
+        # 1. Base64 解码，你的示例 Base64 字符串以 '/9j/' 开头，
+        #    是标准的 JPEG/JPG 文件头。
+        image_bytes = base64.b64decode(screenshot_b64)
+        digest = hashlib.sha256(image_bytes).hexdigest()
+        
+        # 2. 构建文件路径 (base_dir 已经包含了 job_id)
+        filename = f"{timestamp}_{_id}.jpg"
+        file_path = os.path.join(base_dir, filename)
+
+        # 3. 写入文件 (base_dir 已在 process_job 中创建)
+        if USE_IMAGE_STORE:
+            store_path = store_image(image_bytes, digest)
+            if not linked_to_store(file_path, store_path):
+                # 只替换目录项，不重写图片字节
+                link_image(store_path, file_path)
+        else:
+            with open(file_path, 'wb') as f:
+                f.write(image_bytes)
+        return digest
+    except Exception as e:
+        print(f"   错误：处理 ID 为 {_id} 的截图时发生错误: {e}")
+        return None
+
+
+def update_image_manifest(base_dir, entries):
+    """把 {文件名: sha256} 合并写入 job 目录下的图片清单。"""
+    if not entries:
+        return
+    manifest_path = os.path.join(base_dir, IMAGE_MANIFEST_NAME)
+    manifest = {}
+    if os.path.exists(manifest_path):
+        try:
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+        except Exception as e:
+            print(f"   警告：读取图片清单 {manifest_path} 失败: {e}，将重新生成。")
+    manifest.update(entries)
+    with open(manifest_path + '.part', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(manifest_path + '.part', manifest_path)
+
+
 def save_screenshots(data, base_dir):
     """
     解析数据，提取 Base64 编码的截图，并保存为 JPG 文件。
@@ -57,45 +384,355 @@ def save_screenshots(data, base_dir):
     """
     if 'content' not in data or not isinstance(data['content'], list):
         print("   警告：数据结构不正确，未找到 'content' 列表。")
-        return
+        return 0
 
-    saved_count = 0
-    
+    entries = {}
     for item in data['content']:
-        # 确保关键字段存在
-        screenshot_b64 = item.get('screenshot')
-        job_id = item.get('job_id')
-        timestamp = item.get('timestamp')
-        _id = item.get('id')
-
-        if screenshot_b64 and job_id is not None and timestamp is not None and _id is not None:
-            try:
-                # 1. Base64 解码，你的示例 Base64 字符串以 '/9j/' 开头，
-                #    是标准的 JPEG/JPG 文件头。
-                image_bytes = base64.b64decode(screenshot_b64)
-                
-                # 2. 构建文件路径 (base_dir 已经包含了 job_id)
-                filename = f"{timestamp}_{_id}.jpg"
-                file_path = os.path.join(base_dir, filename)
-
-                # 3. 写入文件 (base_dir 已在 main 中创建)
-                with open(file_path, 'wb') as f:
-                    f.write(image_bytes)
-                
-                saved_count += 1
-            except Exception as e:
-                print(f"   错误：处理 ID 为 {_id} 的截图时发生错误: {e}")
+        digest = save_screenshot(item, base_dir)
+        if digest:
+            entries[f"{item['timestamp']}_{item['id']}.jpg"] = digest
+    saved_count = len(entries)
+    update_image_manifest(base_dir, entries)
 
     print(f"   成功提取并保存了 {saved_count} 张截图到 {base_dir} 目录中。")
+    return saved_count
+
+
+class ScreenshotPipeline:
+    """截图解码/写盘流水线。
+
+    每一页到达后把其中的记录交给线程池解码并写盘，主线程随即去处理下一页，
+    从而让请求、解码和写盘三者重叠进行。
+    排队中的截图数量受 max_pending 限制，解码跟不上时会反压到请求端，避免内存堆积。
+    """
+
+    def __init__(self, base_dir, workers=SCREENSHOT_WORKERS, max_pending=None):
+        self.base_dir = base_dir
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(max_pending or workers * 4)
+        self.lock = threading.Lock()
+        self.manifest = {}
+
+    def _save(self, item, page_state):
+        try:
+            digest = save_screenshot(item, self.base_dir)
+            if digest:
+                with self.lock:
+                    self.manifest[f"{item['timestamp']}_{item['id']}.jpg"] = digest
+        finally:
+            self.slots.release()
+            self._page_item_done(page_state)
+
+    def _page_item_done(self, page_state):
+        with self.lock:
+            page_state['remaining'] -= 1
+            finished = page_state['remaining'] == 0
+        if finished and page_state['on_done']:
+            page_state['on_done']()
+
+    def submit_page(self, records, on_done=None):
+        """提交一页记录；on_done 在这一页的截图全部处理完后 (在工作线程中) 调用。"""
+        records = list(records)
+        if not records:
+            if on_done:
+                on_done()
+            return
+        page_state = {'remaining': len(records), 'on_done': on_done}
+        for item in records:
+            self.slots.acquire()
+            self.executor.submit(self._save, item, page_state)
+
+    def close(self):
+        """等待所有截图写完并更新图片清单，返回成功保存的数量。"""
+        self.executor.shutdown(wait=True)
+        update_image_manifest(self.base_dir, self.manifest)
+        return len(self.manifest)
+
+
+def job_log(job_id, message):
+    """多个 job 并发运行时，输出带上 job_id 前缀，便于区分进度。"""
+    print(f"[Job {job_id}] {message}", flush=True)
+
 
+def fetch_page(session, data_headers, params, page_id):
+    """请求单个分页，返回解析后的 JSON。
+
+    session 通常是共享的 Transport，由它负责超时、重试和全局限速。
+    """
+    page_params = params.copy()
+    page_params['page_id'] = str(page_id)
+    response_data = session.get(DATA_URL, headers=data_headers, params=page_params)
+    response_data.raise_for_status()
+    return response_data.json()
+
+
+def lean_record(record):
+    """去掉记录中的截图 Base64，只保留 id、时间戳、participant 等元数据。"""
+    return {k: v for k, v in record.items() if k != 'screenshot'}
+
+
+class JsonStreamWriter:
+    """逐页追加写入元数据 JSON，而不是先在内存中累积整个 job 再 json.dump。
+
+    文件结构与原来一致：开头写入第 0 页响应中的元数据 (id, size, page_count ...)，
+    随后逐条写入 content 数组，最后补上 entity_count。
+    写入过程中使用临时文件，close() 时才替换正式文件，中途失败不会留下半个 JSON。
+    """
+
+    def __init__(self, file_path, metadata):
+        self.file_path = file_path
+        self.tmp_path = file_path + '.part'
+        self.entity_count = 0
+        self.f = open(self.tmp_path, 'w', encoding='utf-8')
+        self.f.write('{\n')
+        for key, value in metadata.items():
+            if key in ('content', 'entity_count'):
+                continue
+            self.f.write(f'    {json.dumps(key)}: {json.dumps(value, ensure_ascii=False)},\n')
+        self.f.write('    "content": [')
+
+    def write_records(self, records):
+        for record in records:
+            if self.entity_count:
+                self.f.write(',')
+            body = json.dumps(record, ensure_ascii=False, indent=4)
+            # 整体缩进两级，与原先 json.dump(..., indent=4) 的输出格式一致
+            self.f.write('\n        ' + body.replace('\n', '\n        '))
+            self.entity_count += 1
+
+    def close(self):
+        self.f.write('\n    ],\n' if self.entity_count else '],\n')
+        self.f.write(f'    "entity_count": {self.entity_count}\n}}\n')
+        self.f.close()
+        os.replace(self.tmp_path, self.file_path)
+
+    def abort(self):
+        self.f.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+class ScreenshotSidecarWriter:
+    """把原始 Base64 截图逐条写入 gzip 压缩的 JSON Lines 文件 (可选)。
+
+    截图本身已保存为 JPG，这里只是为需要原始响应的场景保留一份备份，
+    不影响元数据文件的加载速度。
+    """
 
-def process_job(session, token, job_id):
-    """处理单个 job_id 的分页数据请求、整合、保存 JSON 和提取截图的任务。"""
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.tmp_path = file_path + '.part'
+        self.f = gzip.open(self.tmp_path, 'wt', encoding='utf-8')
 
-    all_content = []
-    page_id = 0
-    page_count = 1 # 初始值，确保循环至少执行一次
-    last_response_metadata = {} # 用于保存第一个（或最后一个成功）的响应元数据
+    def write_records(self, records):
+        for record in records:
+            if record.get('screenshot'):
+                self.f.write(json.dumps({
+                    'id': record.get('id'),
+                    'timestamp': record.get('timestamp'),
+                    'screenshot': record['screenshot'],
+                }) + '\n')
+
+    def copy_existing(self, skip_ids=()):
+        """增量爬取时把已有 sidecar 中的截图接到新截图之后。"""
+        if not os.path.exists(self.file_path):
+            return
+        with gzip.open(self.file_path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                if json.loads(line).get('id') not in skip_ids:
+                    self.f.write(line)
+
+    def close(self):
+        self.f.close()
+        os.replace(self.tmp_path, self.file_path)
+
+    def abort(self):
+        self.f.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+def fetch_pages_in_order(session, data_headers, params, job_id, page_count,
+                         page_concurrency=PAGE_CONCURRENCY, errors=None):
+    """从 page_id=1 开始按页码顺序逐页产出 (page_id, content)。
+
+    最多同时提交 page_concurrency 个请求，只有消费掉一页才会提交下一页，
+    所以内存中最多暂存 page_concurrency 页的数据。
+    和串行版本一致，遇到第一个失败的分页即停止，错误追加到 errors 中。
+    """
+    if page_count <= 1:
+        return
+    max_workers = max(1, min(page_concurrency, page_count - 1))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        next_page_id = 1
+
+        def submit_more():
+            nonlocal next_page_id
+            while next_page_id < page_count and len(futures) < max_workers:
+                futures[next_page_id] = executor.submit(
+                    fetch_page, session, data_headers, params, next_page_id)
+                next_page_id += 1
+
+        submit_more()
+        try:
+            for page_id in range(1, page_count):
+                future = futures.pop(page_id)
+                try:
+                    content = future.result().get('content', [])
+                except Exception as e:
+                    job_log(job_id, f"数据请求第 {page_id + 1} 页失败: {e}")
+                    job_log(job_id, f"警告：仅保留前 {page_id} 页数据。")
+                    if errors is not None:
+                        errors.append(f"page {page_id + 1}: {e}")
+                    return
+                submit_more()
+                yield page_id, content
+        finally:
+            # 出错或调用方提前停止 (例如增量模式遇到已有记录) 时，取消尚未开始的请求
+            for pending in futures.values():
+                pending.cancel()
+
+
+def fetch_pages_as_completed(session, data_headers, params, page_ids,
+                             page_concurrency=PAGE_CONCURRENCY):
+    """并发请求给定的分页，按完成顺序产出 (page_id, content, error)。
+
+    单页失败不会中断其它分页，失败的分页以 error 返回，由调用方决定如何处理。
+    和 fetch_pages_in_order 一样，已提交但尚未被消费的分页最多 page_concurrency 个，
+    消费掉一页才会提交下一页，内存中最多暂存 page_concurrency 页的数据。
+    """
+    if not page_ids:
+        return
+    max_workers = max(1, min(page_concurrency, len(page_ids)))
+    remaining = iter(page_ids)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+
+        def submit_more():
+            while len(futures) < max_workers:
+                page_id = next(remaining, None)
+                if page_id is None:
+                    return
+                futures[executor.submit(fetch_page, session, data_headers, params, page_id)] = page_id
+
+        submit_more()
+        try:
+            while futures:
+                future = next(as_completed(futures))
+                page_id = futures.pop(future)
+                try:
+                    content, error = future.result().get('content', []), None
+                except Exception as e:
+                    content, error = None, e
+                submit_more()
+                yield page_id, content, error
+        finally:
+            # 调用方提前停止时，取消尚未开始的请求
+            for pending in futures:
+                pending.cancel()
+
+
+def checkpoint_path(checkpoint_dir, page_id):
+    return os.path.join(checkpoint_dir, f"page_{page_id:05d}.json")
+
+
+def write_checkpoint(checkpoint_dir, page_id, records):
+    """原子地写入单页断点文件：先写临时文件再替换，中断时不会留下半个文件。"""
+    file_path = checkpoint_path(checkpoint_dir, page_id)
+    with open(file_path + '.part', 'w', encoding='utf-8') as f:
+        json.dump(records, f, ensure_ascii=False)
+    os.replace(file_path + '.part', file_path)
+
+
+def read_checkpoint(checkpoint_dir, page_id):
+    with open(checkpoint_path(checkpoint_dir, page_id), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def prepare_checkpoints(checkpoint_dir, page_count, head_key):
+    """检查已有断点是否仍然有效，返回已完成的分页集合。
+
+    接口按 desc 排序，只要出现新结果，所有分页的内容都会整体后移，
+    因此用 page_count 和第 0 页第一条记录的键判断断点是否可以沿用，
+    不一致时清空断点从头开始。
+    """
+    manifest_path = os.path.join(checkpoint_dir, 'manifest.json')
+    manifest = {'page_count': page_count, 'head_key': list(head_key) if head_key else None,
+                'keep_raw': KEEP_RAW_SCREENSHOTS}
+
+    if os.path.exists(manifest_path):
+        try:
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                if json.load(f) == manifest:
+                    return {page_id for page_id in range(page_count)
+                            if os.path.exists(checkpoint_path(checkpoint_dir, page_id))}
+        except Exception as e:
+            print(f"   警告：读取断点清单 {manifest_path} 失败: {e}")
+        shutil.rmtree(checkpoint_dir, ignore_errors=True)
+
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    with open(manifest_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+    return set()
+
+
+def record_key(record):
+    """记录的排序键。接口按 order=desc 返回，键越大越新。"""
+    return (record.get('timestamp') or 0, record.get('id') or 0)
+
+
+def load_crawl_state(output_dir):
+    """读取上次爬取记录的最新 (timestamp, id)，没有记录时返回 None。"""
+    state_path = os.path.join(output_dir, CRAWL_STATE_FILE_NAME)
+    if not os.path.exists(state_path):
+        return None
+    try:
+        with open(state_path, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        return (state['timestamp'], state['id'])
+    except Exception as e:
+        print(f"   警告：读取爬取状态 {state_path} 失败: {e}，将执行全量爬取。")
+        return None
+
+
+def save_crawl_state(output_dir, newest_key):
+    """记录当前数据集中最新结果的 (timestamp, id)。"""
+    state_path = os.path.join(output_dir, CRAWL_STATE_FILE_NAME)
+    with open(state_path + '.part', 'w', encoding='utf-8') as f:
+        json.dump({'timestamp': newest_key[0], 'id': newest_key[1]}, f)
+    os.replace(state_path + '.part', state_path)
+
+
+def load_existing_records(file_path):
+    """读取已有元数据文件中的记录，用于增量爬取时合并。"""
+    with open(file_path, 'r', encoding='utf-8') as f:
+        return json.load(f).get('content', [])
+
+
+def process_job(session, token, job_id, page_concurrency=PAGE_CONCURRENCY, incremental=INCREMENTAL_CRAWL):
+    """处理单个 job_id 的分页数据请求、保存 JSON 和提取截图的任务。
+
+    先请求第 0 页拿到 page_count，再根据目录中的状态选择：
+    - 全量爬取 (crawl_with_checkpoints)：其余分页并发请求，逐页保存断点，
+      中断或失败后下次只请求缺失的分页；
+    - 增量爬取 (crawl_incremental)：已有数据和爬取状态时，只获取更新的结果并合并。
+    截图交给流水线落盘为 JPG，元数据文件中不再内嵌 Base64。
+
+    返回该 job 的报告 dict：页数、记录数、截图数、错误列表和耗时。
+    """
+    started_at = time.perf_counter()
+    report = {
+        'job_id': job_id,
+        'page_count': 0,
+        'pages_fetched': 0,
+        'entity_count': 0,
+        'screenshot_count': 0,
+        'errors': [],
+        'elapsed': 0.0,
+    }
 
     # 构建带有 Authorization 的 Headers，并更新 Referer
     data_headers = HEADERS.copy()
@@ -104,51 +741,27 @@ def process_job(session, token, job_id):
     
     # URL 参数的基础模板
     params = {
-        'page_id': '0', # 每次循环会更新
+        'page_id': '0', # 每次请求会覆盖
         'job_id': str(job_id), # 使用当前 job_id
         'order': 'desc',
         'hidden': 'false'
     }
 
-    print("\n2. 正在循环请求所有分页数据...")
-    
-    while page_id < page_count:
-        params['page_id'] = str(page_id)
-        
-        try:
-            print(f"   请求 Job ID {job_id} 的第 {page_id + 1} 页 (page_id={page_id})...")
-            
-            response_data = session.get(DATA_URL, headers=data_headers, params=params)
-            response_data.raise_for_status()
-            
-            result_json = response_data.json()
-            
-            # 首次请求时，获取总页数
-            if page_id == 0:
-                page_count = result_json.get('page_count', 1)
-                last_response_metadata = result_json.copy() # 保存元数据
-                print(f"   Job ID {job_id} 总共发现 {page_count} 页数据。")
-            
-            # 累积 content
-            current_content = result_json.get('content', [])
-            all_content.extend(current_content)
-            print(f"   第 {page_id + 1} 页获取 {len(current_content)} 条记录。")
-
-            page_id += 1 # 准备请求下一页
-            
-        except Exception as e:
-            print(f"数据请求 Job ID {job_id} 第 {page_id + 1} 页失败: {e}")
-            break # 遇到错误则停止循环
+    job_log(job_id, "2. 正在请求所有分页数据...")
 
-    # 检查是否有获取到的数据
-    if not all_content:
-        print(f"\n警告：Job ID {job_id} 未获取到任何有效数据，跳过保存。")
-        return
+    # 第 0 页单独请求，用于获取总页数和元数据
+    try:
+        result_json = fetch_page(session, data_headers, params, 0)
+    except Exception as e:
+        job_log(job_id, f"数据请求第 1 页失败: {e}")
+        report['errors'].append(f"page 1: {e}")
+        report['elapsed'] = time.perf_counter() - started_at
+        return report
+
+    page_count = result_json.get('page_count', 1)
+    report['page_count'] = page_count
+    job_log(job_id, f"总共发现 {page_count} 页数据。")
 
-    # ----------------------------------------
-    # 第三步：整合最终数据并保存到 JSON 文件
-    # ----------------------------------------
-    
     # 定义输出目录和文件路径
     output_dir = os.path.join(IMAGE_DIR_BASE, str(job_id))
     output_file_path = os.path.join(output_dir, OUTPUT_FILE_NAME)
@@ -156,41 +769,258 @@ def process_job(session, token, job_id):
     # 确保目标文件夹存在
     os.makedirs(output_dir, exist_ok=True)
 
-    # 整合 JSON 结构
-    final_json = last_response_metadata.copy() 
-    final_json['content'] = all_content
-    final_json['entity_count'] = len(all_content) 
+    # 增量模式：已有数据集时，只取比上次记录的最新结果更新的数据
+    known_key = None
+    if incremental and os.path.exists(output_file_path):
+        known_key = load_crawl_state(output_dir)
 
-    print(f"\n3. 正在写入完整的原始数据文件到目录 '{output_dir}' ...")
-    
-    try:
-        with open(output_file_path, 'w', encoding='utf-8') as f:
-            json.dump(final_json, f, ensure_ascii=False, indent=4)
-            
-        print(f"   文件已保存至: {os.path.abspath(output_file_path)}")
-    except Exception as e:
-        print(f"保存 JSON 文件失败: {e}")
-        return
-    
     # ----------------------------------------
-    # 第四步：提取并保存截图
+    # 第三步：请求剩余分页、写入 JSON 文件，并提取截图
     # ----------------------------------------
-    print("\n4. 正在提取并保存截图...")
+    if known_key is not None:
+        crawl_incremental(session, data_headers, params, job_id, result_json, known_key,
+                          output_dir, report)
+    else:
+        crawl_with_checkpoints(session, data_headers, params, job_id, result_json,
+                               output_dir, page_concurrency, report)
+
+    report['elapsed'] = time.perf_counter() - started_at
+    return report
+
+
+def crawl_with_checkpoints(session, data_headers, params, job_id, first_page, output_dir,
+                           page_concurrency, report):
+    """全量爬取：每页到达后先写单页断点文件，全部分页到齐后再合并为元数据文件。
+
+    断点保存在 {output_dir}/.pages/ 下。某页失败时其它分页照常完成并保存，
+    下次运行只会请求缺失的分页；合并成功后删除断点目录。
+    """
+    page_count = report['page_count']
+    checkpoint_dir = os.path.join(output_dir, CHECKPOINT_DIR_NAME)
+    first_content = first_page.pop('content', [])
+    head_key = record_key(first_content[0]) if first_content else None
+    completed = prepare_checkpoints(checkpoint_dir, page_count, head_key)
+    if completed:
+        job_log(job_id, f"从断点恢复：已有 {len(completed)}/{page_count} 页，只请求缺失的分页。")
+
+    job_log(job_id, f"3. 正在逐页保存断点和截图到目录 '{output_dir}' ...")
+
     # 传递 output_dir 作为保存截图的基础目录
-    save_screenshots(final_json, output_dir)
+    screenshots = ScreenshotPipeline(output_dir)
 
+    def save_page(page_id, current_content):
+        # 截图写完后再落断点，断点存在即代表这一页的截图也已保存
+        stored = current_content if KEEP_RAW_SCREENSHOTS else [lean_record(r) for r in current_content]
+
+        def on_done():
+            try:
+                write_checkpoint(checkpoint_dir, page_id, stored)
+            except Exception as e:
+                job_log(job_id, f"写入第 {page_id + 1} 页断点失败: {e}")
+                report['errors'].append(f"checkpoint {page_id + 1}: {e}")
+
+        screenshots.submit_page(current_content, on_done)
+        job_log(job_id, f"第 {page_id + 1}/{page_count} 页获取 {len(current_content)} 条记录。")
+
+    if 0 not in completed:
+        save_page(0, first_content)
+    del first_content
+
+    missing = [page_id for page_id in range(1, page_count) if page_id not in completed]
+    for page_id, current_content, error in fetch_pages_as_completed(
+            session, data_headers, params, missing, page_concurrency):
+        if error is not None:
+            job_log(job_id, f"数据请求第 {page_id + 1} 页失败: {error}")
+            report['errors'].append(f"page {page_id + 1}: {error}")
+            continue
+        save_page(page_id, current_content)
+
+    report['screenshot_count'] = screenshots.close()
+    job_log(job_id, f"成功提取并保存了 {report['screenshot_count']} 张截图到 {output_dir} 目录中。")
 
-def main():
-    # 使用 Session 保持会话状态
-    session = requests.Session()
-    
     # ----------------------------------------
-    # 第一步：执行登录 (PUT 请求)
+    # 第四步：所有分页到齐后合并断点
     # ----------------------------------------
-    print(f"{'='*50}")
-    print("开始执行脚本：获取登录凭证")
-    print(f"{'='*50}")
-    
+    missing = [page_id for page_id in range(page_count)
+               if not os.path.exists(checkpoint_path(checkpoint_dir, page_id))]
+    report['pages_fetched'] = page_count - len(missing)
+    if missing:
+        job_log(job_id, f"警告：仍缺少 {len(missing)} 页，已保存的分页会保留为断点，下次运行继续。")
+        return
+
+    output_file_path = os.path.join(output_dir, OUTPUT_FILE_NAME)
+    job_log(job_id, "4. 所有分页已到齐，正在合并断点为元数据文件...")
+    writer = JsonStreamWriter(output_file_path, first_page)
+    sidecar = None
+    if KEEP_RAW_SCREENSHOTS:
+        sidecar = ScreenshotSidecarWriter(os.path.join(output_dir, SCREENSHOT_SIDECAR_NAME))
+    newest_key = None
+    try:
+        for page_id in range(page_count):
+            # 每次只读入一页，内存占用与分页大小相当
+            records = read_checkpoint(checkpoint_dir, page_id)
+            writer.write_records(lean_record(record) for record in records)
+            if sidecar:
+                sidecar.write_records(records)
+            for record in records:
+                newest_key = max(newest_key, record_key(record)) if newest_key else record_key(record)
+    except Exception as e:
+        writer.abort()
+        if sidecar:
+            sidecar.abort()
+        job_log(job_id, f"保存 JSON 文件失败: {e}")
+        report['errors'].append(f"json: {e}")
+        return
+
+    # 检查是否有获取到的数据
+    if not writer.entity_count:
+        writer.abort()
+        if sidecar:
+            sidecar.abort()
+        shutil.rmtree(checkpoint_dir, ignore_errors=True)
+        job_log(job_id, "警告：未获取到任何有效数据，跳过保存。")
+        return
+
+    writer.close()
+    if sidecar:
+        sidecar.close()
+    save_crawl_state(output_dir, newest_key)
+    shutil.rmtree(checkpoint_dir, ignore_errors=True)
+    report['entity_count'] = writer.entity_count
+    job_log(job_id, f"文件已保存至: {os.path.abspath(output_file_path)}")
+
+
+def crawl_incremental(session, data_headers, params, job_id, first_page, known_key,
+                      output_dir, report):
+    """增量爬取：只保留比 known_key 更新的记录，遇到已保存的记录就停止翻页，
+    再把已有记录合并到新文件末尾。
+
+    新结果通常只有一两页，这里逐页流式写入，不使用断点。
+    """
+    page_count = report['page_count']
+    output_file_path = os.path.join(output_dir, OUTPUT_FILE_NAME)
+    job_log(job_id, f"增量模式：只获取 timestamp/id 新于 {known_key} 的结果。")
+    newest_key = known_key
+    new_ids = set()
+    reached_known = False
+
+    job_log(job_id, f"3. 正在逐页写入原始数据文件和截图到目录 '{output_dir}' ...")
+
+    writer = JsonStreamWriter(output_file_path, first_page)
+    sidecar = None
+    if KEEP_RAW_SCREENSHOTS:
+        sidecar = ScreenshotSidecarWriter(os.path.join(output_dir, SCREENSHOT_SIDECAR_NAME))
+    # 传递 output_dir 作为保存截图的基础目录
+    screenshots = ScreenshotPipeline(output_dir)
+
+    def write_page(page_id, current_content):
+        nonlocal newest_key, reached_known
+        new_content = [record for record in current_content if record_key(record) > known_key]
+        reached_known = len(new_content) < len(current_content)
+        for record in new_content:
+            new_ids.add(record.get('id'))
+            newest_key = max(newest_key, record_key(record))
+
+        # 截图只落盘为 JPG (以及可选的 sidecar)，元数据文件中不再内嵌 Base64
+        writer.write_records(lean_record(record) for record in new_content)
+        if sidecar:
+            sidecar.write_records(new_content)
+        screenshots.submit_page(new_content)
+        report['pages_fetched'] += 1
+        job_log(job_id, f"第 {page_id + 1}/{page_count} 页获取 {len(new_content)} 条新记录。")
+
+    try:
+        write_page(0, first_page.pop('content', []))
+        if not reached_known:
+            # 新结果通常只在前几页，逐页请求以免预取用不到的分页
+            for page_id, current_content in fetch_pages_in_order(session, data_headers, params, job_id, page_count,
+                                                                 1, report['errors']):
+                write_page(page_id, current_content)
+                if reached_known:
+                    break
+
+        if reached_known:
+            # 合并已有记录 (已按 desc 排列，直接接在新记录之后)
+            job_log(job_id, f"增量模式：新增 {writer.entity_count} 条记录，合并已有数据。")
+            writer.write_records(record for record in load_existing_records(output_file_path)
+                                 if record.get('id') not in new_ids)
+            if sidecar:
+                sidecar.copy_existing(new_ids)
+        elif report['errors']:
+            # 没有接上已有数据就失败了，合并会留下缺口，本次结果作废，下次重新增量
+            raise RuntimeError("增量爬取未能衔接已有数据")
+    except Exception as e:
+        writer.abort()
+        if sidecar:
+            sidecar.abort()
+        screenshots.close()
+        job_log(job_id, f"保存 JSON 文件失败: {e}")
+        report['errors'].append(f"json: {e}")
+        return
+
+    report['screenshot_count'] = screenshots.close()
+    job_log(job_id, f"成功提取并保存了 {report['screenshot_count']} 张截图到 {output_dir} 目录中。")
+
+    writer.close()
+    if sidecar:
+        sidecar.close()
+    save_crawl_state(output_dir, newest_key)
+    report['entity_count'] = writer.entity_count
+    job_log(job_id, f"文件已保存至: {os.path.abspath(output_file_path)}")
+
+
+def split_legacy_data_json(output_dir, keep_raw=KEEP_RAW_SCREENSHOTS):
+    """把旧版内嵌截图的 data.json 拆分为精简的元数据文件和 JPG 截图。
+
+    用于迁移以前爬取的目录；已有的 JPG 会被覆盖为相同内容。
+    返回写入元数据文件的记录数，不存在旧文件时返回 0。
+    """
+    legacy_path = os.path.join(output_dir, LEGACY_OUTPUT_FILE_NAME)
+    if not os.path.exists(legacy_path):
+        return 0
+
+    with open(legacy_path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    content = data.get('content', [])
+
+    writer = JsonStreamWriter(os.path.join(output_dir, OUTPUT_FILE_NAME), data)
+    writer.write_records(lean_record(record) for record in content)
+    writer.close()
+
+    if keep_raw:
+        sidecar = ScreenshotSidecarWriter(os.path.join(output_dir, SCREENSHOT_SIDECAR_NAME))
+        sidecar.write_records(content)
+        sidecar.close()
+
+    save_screenshots(data, output_dir)
+    return writer.entity_count
+
+
+def migrate_legacy_directories(base_dir=IMAGE_DIR_BASE):
+    """扫描 base_dir 下只有旧版 data.json、还没有元数据文件的任务目录，逐个拆分迁移。
+
+    不需要登录，main() 在爬取前调用；已迁移的目录 (存在元数据文件) 会被跳过。
+    返回迁移的目录数。
+    """
+    migrated = 0
+    for entry in sorted(os.listdir(base_dir)):
+        output_dir = os.path.join(base_dir, entry)
+        if (entry.startswith('.') or not os.path.isdir(output_dir)
+                or not os.path.exists(os.path.join(output_dir, LEGACY_OUTPUT_FILE_NAME))
+                or os.path.exists(os.path.join(output_dir, OUTPUT_FILE_NAME))):
+            continue
+        try:
+            entity_count = split_legacy_data_json(output_dir)
+        except Exception as e:
+            print(f"   [{entry}] 迁移 {LEGACY_OUTPUT_FILE_NAME} 失败: {e}")
+            continue
+        print(f"   [{entry}] 已拆分 {LEGACY_OUTPUT_FILE_NAME} -> {OUTPUT_FILE_NAME} ({entity_count} 条记录)")
+        migrated += 1
+    return migrated
+
+
+def login(session):
+    """执行登录 (PUT 请求)，返回 token；失败时返回 None。"""
     print(f"1. 正在尝试登录: {LOGIN_URL} ...")
     
     try:
@@ -203,28 +1033,99 @@ def main():
         if not token:
             print("错误：登录成功但未找到 Token 字段。")
             print("返回数据预览:", json.dumps(login_data, indent=2))
-            return
+            return None
 
         print(f"   登录成功! 获取到的 Token: {token[:15]}...")
+        return token
 
     except Exception as e:
         print(f"登录失败: {e}")
+        return None
+
+
+def run_jobs(session, token, job_ids, job_concurrency=JOB_CONCURRENCY, page_concurrency=PAGE_CONCURRENCY):
+    """并发调度多个 job。
+
+    所有 job 共用同一个 session 和 token。session 通常是 Transport，
+    全局在途请求数上限、限速和重试都由它统一控制。
+    返回按 job_ids 顺序排列的报告列表。
+    """
+    reports = {}
+
+    with ThreadPoolExecutor(max_workers=max(1, job_concurrency)) as executor:
+        futures = {
+            executor.submit(process_job, session, token, job_id, page_concurrency): job_id
+            for job_id in job_ids
+        }
+        for future in as_completed(futures):
+            job_id = futures[future]
+            try:
+                reports[job_id] = future.result()
+            except Exception as e:
+                reports[job_id] = {'job_id': job_id, 'page_count': 0, 'pages_fetched': 0,
+                                   'entity_count': 0, 'screenshot_count': 0,
+                                   'errors': [str(e)], 'elapsed': 0.0}
+            job_log(job_id, "处理完毕")
+
+    return [reports[job_id] for job_id in job_ids]
+
+
+def print_reports(reports):
+    """打印每个 job 的汇总报告。"""
+    print(f"\n{'='*50}")
+    print("任务报告：")
+    for report in reports:
+        status = "OK" if not report['errors'] else f"{len(report['errors'])} 个错误"
+        print(f"   Job {report['job_id']}: {report['pages_fetched']}/{report['page_count']} 页, "
+              f"{report['entity_count']} 条记录, {report['screenshot_count']} 张截图, "
+              f"{report['elapsed']:.1f}s, {status}")
+        for error in report['errors']:
+            print(f"      - {error}")
+
+
+def main():
+    # 使用 Session 保持会话状态
+    session = requests.Session()
+    # 连接池大小需覆盖全局并发请求数，否则多余的连接会被丢弃重建
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=MAX_IN_FLIGHT_REQUESTS)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    # 所有请求都经过同一个 Transport：超时、重试、Retry-After、全局限速和 token 刷新
+    transport = Transport(session)
+    auth = AuthManager(transport)
+
+    # 以前爬取的目录只有内嵌截图的 data.json，先拆分出元数据文件和 JPG 截图
+    if migrate_legacy_directories():
+        print("旧版 data.json 迁移完成。")
+    
+    # ----------------------------------------
+    # 第一步：执行登录 (PUT 请求)
+    # ----------------------------------------
+    print(f"{'='*50}")
+    print("开始执行脚本：获取登录凭证")
+    print(f"{'='*50}")
+    
+    if not auth.login():
         return
+    transport.auth = auth
     
     # ----------------------------------------
-    # 第二步：循环处理所有 Job ID
+    # 第二步：并发处理所有 Job ID
     # ----------------------------------------
     
     print(f"\n{'='*50}")
     print(f"开始处理 {len(JOB_IDS_TO_PROCESS)} 个任务：{', '.join(JOB_IDS_TO_PROCESS)}")
+    print(f"并发 job 数: {JOB_CONCURRENCY}，全局在途请求上限: {MAX_IN_FLIGHT_REQUESTS}，"
+          f"初始限速: {RATE_LIMIT_PER_SECOND} 请求/秒")
     print(f"{'='*50}")
 
-    for job_id in JOB_IDS_TO_PROCESS:
-        process_job(session, token, job_id)
-        print(f"\n--- Job ID {job_id} 处理完毕 ---")
+    started_at = time.perf_counter()
+    reports = run_jobs(transport, auth.token, JOB_IDS_TO_PROCESS)
+    print_reports(reports)
 
     print(f"\n{'='*50}")
-    print("所有任务处理完成。")
+    print(f"所有任务处理完成，总耗时 {time.perf_counter() - started_at:.1f}s。")
+    print(f"请求统计: {transport.stats}")
     print(f"{'='*50}")
 
 if __name__ == "__main__":